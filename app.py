@@ -3,10 +3,19 @@ import openai
 import os
 import csv
 import base64
+import hashlib
+import html
+import math
+import time
+import mmap
+import tempfile
+import threading
+import weakref
 import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import requests
 import urllib.parse
-from datetime import datetime
+from datetime import datetime, timedelta
 from docx import Document
 from docx.document import Document as DocumentType
 from docx.oxml.table import CT_Tbl
@@ -17,56 +26,107 @@ from PIL import Image
 import io
 import pdfplumber
 import fitz  # PyMuPDF
+from figure_raster import (
+    MAX_TOTAL_FIGURE_PIXELS, find_vector_figure_regions, get_raster_pool, plan_dpi, rasterize_region
+)
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from dotenv import load_dotenv
+import uuid
+from storage import ROLLUP_FIELDS, SUBMISSION_FIELDS, open_store
 
 # Load environment variables
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 # Configuration
-SUBMISSION_LOG = "submission_log.csv"
+STORAGE_URL = os.getenv("STORAGE_URL", "sqlite:///shared_state.db")
+SUBMISSION_LOG = "submission_log.csv"  # legacy log, imported into the store once
+MODULES = [
+    "2 - Research Questions",
+    "3 - Study Design",
+    "4 - Human Research Ethics",
+    "5 - Presenting Results",
+    "6 - Discussion Section"
+]
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin123")
 
+# Upload memory limits (sizes in MB, overridable from .env)
+MB = 1024 * 1024
+SPOOL_THRESHOLD_BYTES = int(os.getenv("SPOOL_THRESHOLD_MB", "4")) * MB
+MAX_DOCUMENT_BYTES = int(os.getenv("MAX_DOCUMENT_MB", "50")) * MB
+SESSION_MEMORY_CAP_BYTES = int(os.getenv("SESSION_MEMORY_CAP_MB", "150")) * MB
+GLOBAL_MEMORY_CAP_BYTES = int(os.getenv("GLOBAL_MEMORY_CAP_MB", "1024")) * MB
+UPLOAD_CHUNK_BYTES = 1 * MB
+
+# Rubric prompts
+RUBRIC_DIR = "prompts"
+RUBRIC_RELOAD_SECONDS = float(os.getenv("RUBRIC_RELOAD_SECONDS", "2"))
+MAX_REQUEST_TOKENS = int(os.getenv("MAX_REQUEST_TOKENS", "100000"))
+DEFAULT_IMAGE_PROMPT = "Analyze these figures and provide feedback on clarity, appropriateness, and professional presentation standards."
+
+# Local citation store
+CITATION_FRESHNESS_DAYS = int(os.getenv("CITATION_FRESHNESS_DAYS", "180"))
+CITATION_MIN_SCORE = float(os.getenv("CITATION_MIN_SCORE", "8"))
+CITATION_SKIP_MIN = int(os.getenv("CITATION_SKIP_MIN", "4"))  # strong matches needed to skip web search
+CITATION_MAX_CANDIDATES = int(os.getenv("CITATION_MAX_CANDIDATES", "6"))
+CITATION_HARVEST_WORKERS = int(os.getenv("CITATION_HARVEST_WORKERS", "2"))
+
+# Per-group usage quotas (0 disables a limit; admins can override per group)
+QUOTA_REVIEWS_PER_HOUR = int(os.getenv("QUOTA_REVIEWS_PER_HOUR", "4"))
+QUOTA_TOKENS_PER_DAY = int(os.getenv("QUOTA_TOKENS_PER_DAY", "400000"))
+QUOTA_COOLDOWN_SECONDS = int(os.getenv("QUOTA_COOLDOWN_SECONDS", "120"))
+FAIR_SHARE_TOKENS_PER_HOUR = int(os.getenv("FAIR_SHARE_TOKENS_PER_HOUR", "0"))
+
+# Worker pools shared by all sessions
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "8"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "4"))
+
 
 # ─────────────────────────────────────────────
 # Submission log helpers
 # ─────────────────────────────────────────────
 
+@st.cache_resource
+def get_store():
+    """Open the shared store (see storage.py), importing the legacy CSV log on first use."""
+    store = open_store(STORAGE_URL)
+    if hasattr(store, "import_csv_once"):
+        store.import_csv_once(SUBMISSION_LOG)
+    return store
+
 def load_submissions():
-    submissions = []
-    if os.path.exists(SUBMISSION_LOG):
-        try:
-            with open(SUBMISSION_LOG, mode='r', newline='', encoding='utf-8') as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    submissions.append(row)
-        except Exception as e:
-            st.error(f"Error loading submissions: {e}")
-    return submissions
-
-def save_submissions(submissions):
     try:
-        with open(SUBMISSION_LOG, mode='w', newline='', encoding='utf-8') as file:
-            fieldnames = ["timestamp", "module", "groupnumber", "included_figures"]
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            for submission in submissions:
-                writer.writerow(submission)
-        return True
+        return get_store().list_submissions()
     except Exception as e:
-        st.error(f"Error saving submissions: {e}")
-        return False
+        st.error(f"Error loading submissions: {e}")
+        return []
 
-def log_submission(module, group_number, included_figures):
-    submissions = load_submissions()
+def log_submission(module, group_number, included_figures, rubric_version=""):
     new_submission = {
+        "submission_id": uuid.uuid4().hex,
         "timestamp": datetime.now().isoformat(),
         "module": module,
         "groupnumber": str(group_number),
-        "included_figures": str(included_figures)
+        "included_figures": str(included_figures),
+        "rubric_version": rubric_version
     }
-    submissions.append(new_submission)
-    return save_submissions(submissions)
+    try:
+        get_store().append_submission(new_submission)
+        return True
+    except Exception as e:
+        st.error(f"Error saving submissions: {e}")
+        return False
+
+def apply_admin_edit(edit, *args):
+    """Run a store edit (e.g. get_store().remove_submission) and report failures like a save."""
+    try:
+        edit(*args)
+        return True
+    except Exception as e:
+        st.error(f"Error saving submissions: {e}")
+        return False
 
 def get_submission_stats(submissions):
     if not submissions:
@@ -99,6 +159,259 @@ def format_timestamp(timestamp_str):
         return timestamp_str
 
 
+# ─────────────────────────────────────────────
+# Submission rollups and export
+# ─────────────────────────────────────────────
+#
+# Hourly submission counts per module and group are maintained by the store
+# alongside every write, so the admin charts never rescan the raw log.
+
+def rollups_to_frame(rollups):
+    frame = pd.DataFrame(
+        [(hour, module, group, count) for (hour, module, group), count in rollups.items()],
+        columns=ROLLUP_FIELDS
+    )
+    frame["hour"] = pd.to_datetime(frame["hour"])
+    return frame
+
+def export_submissions(file_format, start_date=None, end_date=None, modules=None, batch_size=5000):
+    """Write the filtered log to a temp file in CSV or Parquet, batch by batch.
+
+    Returns the path of the export; the caller is responsible for removing it.
+    """
+    rows = get_store().iter_submissions(start_date, end_date, modules)
+    fd, path = tempfile.mkstemp(prefix="submissions_export_", suffix=f".{file_format}")
+    if file_format == "csv":
+        with os.fdopen(fd, mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=SUBMISSION_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    os.close(fd)
+    schema = pa.schema([(field, pa.string()) for field in SUBMISSION_FIELDS])
+    with pq.ParquetWriter(path, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+    return path
+
+
+# ─────────────────────────────────────────────
+# Upload spooling and memory budgets
+# ─────────────────────────────────────────────
+#
+# Every byte of an uploaded document held in memory (and any figure bytes
+# pulled out of it) is charged to both the session budget and the
+# process-wide budget while the upload is active, so one image-heavy report
+# or a burst of sessions is rejected up front instead of OOM-killing the
+# server. Bytes spooled to disk are only limited by MAX_DOCUMENT_BYTES, and
+# an upload is released as soon as it is no longer needed.
+
+class DocumentTooLargeError(ValueError):
+    """Raised when a document would exceed the per-document or memory caps."""
+
+
+class MemoryBudget:
+    """Thread-safe byte counter with a hard limit."""
+
+    def __init__(self, limit, label):
+        self.limit = limit
+        self.label = label
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def try_reserve(self, nbytes):
+        """Reserve `nbytes` and return True, or return False if that would exceed the limit."""
+        with self._lock:
+            if self.used + nbytes > self.limit:
+                return False
+            self.used += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self._lock:
+            self.used = max(0, self.used - nbytes)
+
+
+# Streamlit re-runs this script on every interaction, so process-wide objects
+# are created once through st.cache_resource and shared by all sessions.
+# They must not raise exception classes defined in this file: each rerun
+# defines new classes that an older instance's exceptions would not match.
+
+@st.cache_resource
+def get_global_memory_budget():
+    return MemoryBudget(GLOBAL_MEMORY_CAP_BYTES, "server")
+
+
+def get_session_memory_budget():
+    """Return this session's memory budget, creating it on first use."""
+    if 'memory_budget' not in st.session_state:
+        st.session_state.memory_budget = MemoryBudget(SESSION_MEMORY_CAP_BYTES, "session")
+    return st.session_state.memory_budget
+
+
+def _close_spool(state, budgets):
+    """Release a spool's reservations and remove its temp file (also runs on GC)."""
+    if state["mmap"] is not None:
+        state["mmap"].close()
+    if state["file"] is not None:
+        state["file"].close()
+    if state["path"] is not None:
+        try:
+            os.remove(state["path"])
+        except OSError:
+            pass
+    for budget in budgets:
+        budget.release(state["reserved"])
+    state.update(mmap=None, file=None, path=None, reserved=0)
+
+
+class SpooledUpload:
+    """Document bytes kept in memory below SPOOL_THRESHOLD_BYTES and spooled to a
+    memory-mapped temp file above it."""
+
+    def __init__(self, session_budget, suffix=""):
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._buffer = bytearray()
+        self._suffix = suffix
+        self._budgets = (session_budget, get_global_memory_budget())
+        self._state = {"mmap": None, "file": None, "path": None, "reserved": 0}
+        self._finalizer = weakref.finalize(self, _close_spool, self._state, self._budgets)
+
+    @property
+    def digest(self):
+        """sha256 of the bytes written so far (identifies a document's exact content)."""
+        return self._sha256.hexdigest()
+
+    @property
+    def path(self):
+        """Path of the spooled temp file, or None if the upload is held in memory."""
+        return self._state["path"]
+
+    def reserve(self, nbytes):
+        """Charge in-memory bytes (e.g. extracted figures) to this upload's budgets."""
+        for i, budget in enumerate(self._budgets):
+            if not budget.try_reserve(nbytes):
+                for reserved in self._budgets[:i]:
+                    reserved.release(nbytes)
+                raise DocumentTooLargeError(
+                    f"This document is too large to process right now ({budget.label} limit of "
+                    f"{budget.limit // MB} MB reached). Please compress your figures or try again later."
+                )
+        self._state["reserved"] += nbytes
+
+    def write(self, chunk):
+        if self.size + len(chunk) > MAX_DOCUMENT_BYTES:
+            raise DocumentTooLargeError(
+                f"Documents larger than {MAX_DOCUMENT_BYTES // MB} MB cannot be reviewed. "
+                "Please compress your figures and try again."
+            )
+        self.size += len(chunk)
+        self._sha256.update(chunk)
+        if self._state["file"] is None:
+            self.reserve(len(chunk))
+            self._buffer += chunk
+            if len(self._buffer) > SPOOL_THRESHOLD_BYTES:
+                fd, path = tempfile.mkstemp(prefix="bioc32_upload_", suffix=self._suffix)
+                self._state["path"] = path
+                self._state["file"] = os.fdopen(fd, "w+b")
+                self._state["file"].write(self._buffer)
+                # The bytes now live on disk, so stop charging them to the budgets
+                for budget in self._budgets:
+                    budget.release(len(self._buffer))
+                self._state["reserved"] -= len(self._buffer)
+                self._buffer = bytearray()
+        else:
+            self._state["file"].write(chunk)
+
+    def finish(self):
+        """Stop writing and map the spooled file (if any) read-only."""
+        if self._state["file"] is not None:
+            self._state["file"].flush()
+            self._state["mmap"] = mmap.mmap(self._state["file"].fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._buffer = bytes(self._buffer)
+        return self
+
+    def open(self):
+        """Return a fresh seekable reader over the document bytes."""
+        if self._state["mmap"] is not None:
+            return mmap.mmap(self._state["file"].fileno(), 0, access=mmap.ACCESS_READ)
+        return io.BytesIO(self._buffer)
+
+    def getvalue(self):
+        """Return the document bytes (only used for small, in-memory uploads)."""
+        if self._state["mmap"] is not None:
+            return self._state["mmap"][:]
+        return self._buffer
+
+    def close(self):
+        self._buffer = b""
+        self._finalizer()
+
+
+def spool_chunks(chunks, slot, declared_size=None, suffix=""):
+    """Spool an iterable of byte chunks into a SpooledUpload registered under `slot`.
+
+    The upload previously held in the same slot is released first, and a
+    declared size over the cap is rejected before any bytes are read.
+    """
+    release_upload(slot)
+    if declared_size and declared_size > MAX_DOCUMENT_BYTES:
+        raise DocumentTooLargeError(
+            f"Documents larger than {MAX_DOCUMENT_BYTES // MB} MB cannot be reviewed. "
+            "Please compress your figures and try again."
+        )
+    upload = SpooledUpload(get_session_memory_budget(), suffix=suffix)
+    try:
+        for chunk in chunks:
+            if chunk:
+                upload.write(chunk)
+        upload.finish()
+    except Exception:
+        upload.close()
+        raise
+    if 'active_uploads' not in st.session_state:
+        st.session_state.active_uploads = {}
+    st.session_state.active_uploads[slot] = upload
+    return upload
+
+
+def spool_upload(uploaded_file, slot, suffix=""):
+    """Spool a Streamlit UploadedFile in fixed-size chunks."""
+    uploaded_file.seek(0)
+    chunks = iter(lambda: uploaded_file.read(UPLOAD_CHUNK_BYTES), b"")
+    return spool_chunks(chunks, slot, getattr(uploaded_file, "size", None), suffix)
+
+
+def release_upload(slot):
+    """Close the upload held in `slot`, returning its bytes to the budgets."""
+    active = st.session_state.get('active_uploads', {})
+    upload = active.pop(slot, None)
+    if upload is not None:
+        upload.close()
+
+
+class ImageHandle:
+    """A figure kept as its encoded bytes and only decoded when sent to the API."""
+
+    def __init__(self, data, width=None, height=None, caption=None):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.caption = caption
+
+    def open(self):
+        return Image.open(io.BytesIO(self.data))
+
+
 # ─────────────────────────────────────────────
 # Google Docs helpers
 # ─────────────────────────────────────────────
@@ -115,12 +428,16 @@ def extract_gdoc_id(url):
             return match.group(1)
     return None
 
-def fetch_gdoc_as_docx(doc_id):
-    """Download a Google Doc as a .docx file (bytes)."""
+def fetch_gdoc_as_docx(doc_id, slot):
+    """Stream a Google Doc's .docx export into a SpooledUpload."""
     export_url = f"https://docs.google.com/document/d/{doc_id}/export?format=docx"
-    response = requests.get(export_url, timeout=30)
+    response = requests.get(export_url, timeout=30, stream=True)
     if response.status_code == 200:
-        return io.BytesIO(response.content)
+        with response:
+            declared_size = int(response.headers.get("Content-Length") or 0)
+            return spool_chunks(
+                response.iter_content(UPLOAD_CHUNK_BYTES), slot, declared_size, suffix=".docx"
+            )
     elif response.status_code == 403:
         raise PermissionError(
             "Could not access this Google Doc. Please make sure sharing is set to "
@@ -137,33 +454,76 @@ def fetch_gdoc_as_docx(doc_id):
 # PDF helpers
 # ─────────────────────────────────────────────
 
-def extract_text_from_pdf(pdf_bytes):
-    """Extract all text from a PDF using pdfplumber."""
+def extract_text_from_pdf(upload):
+    """Extract all text from a spooled PDF using pdfplumber."""
     text_parts = []
-    with pdfplumber.open(pdf_bytes) as pdf:
+    with pdfplumber.open(upload.open()) as pdf:
         for page in pdf.pages:
             page_text = page.extract_text()
             if page_text:
                 text_parts.append(page_text)
+            page.flush_cache()
     return "\n".join(text_parts)
 
-def extract_images_from_pdf(pdf_bytes):
-    """Extract all images from a PDF using PyMuPDF (fitz)."""
+def open_pdf_with_fitz(upload):
+    """Open a spooled PDF with PyMuPDF, from disk when it was spooled there."""
+    if upload.path:
+        return fitz.open(upload.path, filetype="pdf")
+    return fitz.open(stream=upload.getvalue(), filetype="pdf")
+
+def extract_images_from_pdf(upload):
+    """Extract a PDF's figures as lazy ImageHandles, in page order.
+
+    Embedded raster images are taken as-is with PyMuPDF (fitz); vector-drawn
+    charts are located by figure_raster and rendered on its process pool.
+    """
+    figures = []  # (page number, y position, ImageHandle or pending render)
+    seen_xrefs = set()
+    pixels_left = MAX_TOTAL_FIGURE_PIXELS
+    source = upload.path or upload.getvalue()
+    pool = None
+    with open_pdf_with_fitz(upload) as doc:
+        for page in doc:
+            raster_rects = []
+            for img in page.get_images(full=True):
+                xref = img[0]
+                width, height = img[2], img[3]
+                if width <= 100 or height <= 100:  # skip tiny icons
+                    continue
+                rects = page.get_image_rects(xref)
+                raster_rects.extend(rects)
+                if xref in seen_xrefs:
+                    continue
+                seen_xrefs.add(xref)
+                try:
+                    image_bytes = doc.extract_image(xref)["image"]
+                except Exception:
+                    continue
+                upload.reserve(len(image_bytes))
+                y = rects[0].y0 if rects else 0
+                figures.append((page.number, y, ImageHandle(image_bytes, width, height)))
+
+            for region in find_vector_figure_regions(page, raster_rects):
+                dpi, pixels = plan_dpi(region, pixels_left)
+                if dpi is None:
+                    break
+                pixels_left -= pixels
+                if pool is None:
+                    pool = get_raster_pool()
+                render = pool.submit(rasterize_region, source, page.number, tuple(region), dpi)
+                figures.append((page.number, region.y0, render))
+
     images = []
-    pdf_bytes.seek(0)
-    doc = fitz.open(stream=pdf_bytes.read(), filetype="pdf")
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        for img_index, img in enumerate(page.get_images(full=True)):
-            xref = img[0]
-            base_image = doc.extract_image(xref)
-            image_bytes = base_image["image"]
-            try:
-                pil_image = Image.open(io.BytesIO(image_bytes))
-                if pil_image.width > 100 and pil_image.height > 100:  # skip tiny icons
-                    images.append(pil_image)
-            except Exception:
-                continue
+    for _, _, figure in sorted(figures, key=lambda f: (f[0], f[1])):
+        if isinstance(figure, ImageHandle):
+            images.append(figure)
+            continue
+        try:
+            png_bytes, width, height = figure.result()
+        except Exception:
+            continue
+        upload.reserve(len(png_bytes))
+        images.append(ImageHandle(png_bytes, width, height))
     return images
 
 
@@ -171,18 +531,216 @@ def extract_images_from_pdf(pdf_bytes):
 # docx helpers
 # ─────────────────────────────────────────────
 
-def extract_images_from_docx(doc):
-    """Extract all images from a Word document."""
-    images = []
-    for rel in doc.part.rels.values():
-        if "image" in rel.target_ref:
+# "Figure 1." / "Fig. 2:" / "Figure 3 -", but not a sentence such as "Figure 1 shows..."
+CAPTION_PATTERN = re.compile(r'^\s*(figure|fig\.?)\s*\d+[a-z]?\s*[.:\-\u2013\u2014]', re.IGNORECASE)
+
+def iter_block_items(parent):
+    """Yield each paragraph and table child of a document or table cell, in document order."""
+    if isinstance(parent, DocumentType):
+        parent_elm = parent.element.body
+    elif isinstance(parent, _Cell):
+        parent_elm = parent._tc
+    else:
+        raise ValueError(f"Cannot iterate blocks of {type(parent).__name__}")
+    for child in parent_elm.iterchildren():
+        if isinstance(child, CT_P):
+            yield Paragraph(child, parent)
+        elif isinstance(child, CT_Tbl):
+            yield Table(child, parent)
+
+def iter_docx_content(parent):
+    """Walk a document once, yielding ("paragraph", Paragraph), ("table", text)
+    and ("image", rId) items in document order.
+
+    Tables are flattened to one " | "-separated line per row; images inside
+    table cells are yielded after their table's text.
+    """
+    for block in iter_block_items(parent):
+        if isinstance(block, Paragraph):
+            for r_id in block._element.xpath('.//a:blip/@r:embed'):
+                yield "image", r_id
+            yield "paragraph", block
+        else:
+            rows = []
+            cell_images = []
+            for row in block.rows:
+                cells = []
+                seen_tcs = set()
+                for cell in row.cells:
+                    if id(cell._tc) in seen_tcs:  # merged cells repeat the same <w:tc>
+                        continue
+                    seen_tcs.add(id(cell._tc))
+                    parts = []
+                    for kind, item in iter_docx_content(cell):
+                        if kind == "image":
+                            cell_images.append(item)
+                        elif kind == "paragraph":
+                            if item.text.strip():
+                                parts.append(item.text.strip())
+                        else:
+                            parts.append(item.replace("\n", "; "))
+                    cells.append(" ".join(parts))
+                if any(cells):
+                    rows.append(" | ".join(cells))
+            if rows:
+                yield "table", "\n".join(rows)
+            for r_id in cell_images:
+                yield "image", r_id
+
+def _is_caption(paragraph):
+    style_name = paragraph.style.name if paragraph.style is not None else ""
+    return style_name.lower().startswith("caption") or bool(CAPTION_PATTERN.match(paragraph.text))
+
+def extract_docx_content(doc, analyze_figures=False):
+    """Extract text (including tables) and figures from a Word document in a single pass.
+
+    Each figure is marked in the text as "[Figure N]" at its position and,
+    when `analyze_figures` is set, returned as a lazy ImageHandle paired with
+    the caption paragraph directly below (or, failing that, above) it.
+    """
+    lines = []
+    figures = []
+    figure_numbers = {}
+    pending = []  # (figure, caption above it or None) still waiting for a caption below
+
+    def settle(caption_below=None):
+        for handle, caption_above in pending:
+            handle.caption = caption_below or caption_above
+        pending.clear()
+
+    last_paragraph = None
+    for kind, item in iter_docx_content(doc):
+        if kind == "image":
+            if item not in figure_numbers:
+                figure_numbers[item] = len(figure_numbers) + 1
+                if analyze_figures:
+                    handle = ImageHandle(doc.part.related_parts[item].blob)
+                    caption_above = None
+                    if last_paragraph is not None and _is_caption(last_paragraph):
+                        caption_above = last_paragraph.text.strip()
+                    pending.append((handle, caption_above))
+                    figures.append(handle)
+            lines.append(f"[Figure {figure_numbers[item]}]")
+            last_paragraph = None
+        elif kind == "paragraph":
+            text = item.text
+            if text.strip():
+                if pending and _is_caption(item):
+                    settle(text.strip())
+                    last_paragraph = None  # already used as a caption below a figure
+                else:
+                    settle()
+                    last_paragraph = item
+            lines.append(text)
+        else:
+            lines.append(item)
+            settle()
+            last_paragraph = None
+    settle()
+    return "\n".join(lines), figures
+
+
+# ─────────────────────────────────────────────
+# Rubric registry
+# ─────────────────────────────────────────────
+#
+# Every prompts/*.txt file is read and validated once, then re-read only when
+# its mtime changes (checked at most every RUBRIC_RELOAD_SECONDS), so rubric
+# edits go live without a restart. Each rubric is a dict carrying its text, a
+# short content hash (`version`) for logs and cache keys, and its token count.
+
+@st.cache_resource
+def get_token_encoder():
+    """Return a tiktoken encoder, or None to fall back to a character estimate."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+def count_tokens(text):
+    encoder = get_token_encoder()
+    if encoder is None:
+        return len(text) // 4 + 1
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+class RubricRegistry:
+    """Prompt files keyed by name (e.g. "rubric_3", "image_rubric_5")."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.rubrics = {}
+        self.problems = []
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+
+    def refresh(self, force=False):
+        """Load new or modified prompt files and drop deleted ones.
+
+        A file that fails validation keeps its last good version and is
+        reported in `problems`.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._checked_at < RUBRIC_RELOAD_SECONDS:
+                return
+            self._checked_at = now
+            problems = []
+            seen = set()
             try:
-                image_data = rel.target_part.blob
-                image = Image.open(io.BytesIO(image_data))
-                images.append(image)
-            except Exception as e:
-                st.warning(f"Could not extract an image: {e}")
-    return images
+                filenames = sorted(os.listdir(self.directory))
+            except OSError as e:
+                self.problems = [f"Cannot read {self.directory}/: {e}"]
+                return
+            for filename in filenames:
+                if not filename.endswith(".txt"):
+                    continue
+                name = filename[:-len(".txt")]
+                path = os.path.join(self.directory, filename)
+                seen.add(name)
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                    current = self.rubrics.get(name)
+                    if current is not None and current["mtime"] == mtime:
+                        continue
+                    with open(path, 'r', encoding='utf-8') as f:
+                        text = f.read()
+                except (OSError, UnicodeDecodeError) as e:
+                    problems.append(f"{filename}: {e}")
+                    continue
+                if not text.strip():
+                    problems.append(f"{filename} is empty")
+                    continue
+                self.rubrics[name] = {
+                    "name": name,
+                    "text": text,
+                    "version": hashlib.sha256(text.encode('utf-8')).hexdigest()[:12],
+                    "tokens": count_tokens(text),
+                    "mtime": mtime,
+                    "loaded_at": datetime.now().isoformat(timespec='seconds'),
+                }
+            for name in set(self.rubrics) - seen:
+                del self.rubrics[name]
+            for name in REQUIRED_RUBRICS:
+                if name not in self.rubrics:
+                    problems.append(f"{name}.txt is missing")
+            self.problems = problems
+
+    def get(self, name):
+        self.refresh()
+        return self.rubrics.get(name)
+
+    def get_image_rubric(self, module):
+        """Return the module's image rubric, falling back to image_rubric_default, or None."""
+        return self.get(f"image_rubric_{module.split(' ')[0]}") or self.get("image_rubric_default")
+
+
+@st.cache_resource
+def get_rubric_registry():
+    registry = RubricRegistry(RUBRIC_DIR)
+    registry.refresh(force=True)
+    return registry
 
 
 # ─────────────────────────────────────────────
@@ -190,28 +748,42 @@ def extract_images_from_docx(doc):
 # ─────────────────────────────────────────────
 
 def encode_image_for_api(image):
-    """Convert PIL Image to base64 string for API."""
+    """Convert a PIL Image or ImageHandle to base64 string for API."""
+    if isinstance(image, ImageHandle):
+        with image.open() as decoded:
+            return encode_image_for_api(decoded)
     buffer = io.BytesIO()
-    if image.mode in ("RGBA", "P"):
+    if image.mode not in ("RGB", "L"):
         image = image.convert("RGB")
     image.save(buffer, format="JPEG")
     return base64.b64encode(buffer.getvalue()).decode()
 
-def analyze_images_with_gpt4_vision(images, module):
-    """Analyze images using GPT-4 Vision."""
-    if not images:
-        return "No figures found in the document."
+@st.cache_resource
+def get_image_executor():
+    return ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="encode")
 
-    image_prompt_file_path = f"prompts/image_rubric_{module.split(' ')[0]}.txt"
+def _try_encode_image(image):
     try:
-        with open(image_prompt_file_path, 'r', encoding='utf-8') as f:
-            prompt = f.read()
-    except FileNotFoundError:
-        try:
-            with open("prompts/image_rubric_default.txt", 'r', encoding='utf-8') as f:
-                prompt = f.read()
-        except FileNotFoundError:
-            prompt = "Analyze these figures and provide feedback on clarity, appropriateness, and professional presentation standards."
+        return encode_image_for_api(image)
+    except Exception:
+        return None
+
+def encode_images_for_api(images):
+    """Decode and base64-encode figures in parallel on the image worker pool.
+
+    Returns (images, encoded_images) with any figure that could not be
+    decoded (e.g. a JBIG2 or corrupt image) dropped from both lists.
+    """
+    encoded = list(get_image_executor().map(_try_encode_image, images))
+    kept = [(image, data) for image, data in zip(images, encoded) if data is not None]
+    return [image for image, _ in kept], [data for _, data in kept]
+
+def analyze_images_with_gpt4_vision(images, prompt, encoded_images=None, token_counts=None):
+    """Analyze images using GPT-4 Vision, reusing `encoded_images` when already encoded."""
+    if encoded_images is None:
+        images, encoded_images = encode_images_for_api(images)
+    if not images:
+        return "No figures found in the document."
 
     messages = [
         {
@@ -220,12 +792,15 @@ def analyze_images_with_gpt4_vision(images, module):
         }
     ]
 
-    for i, image in enumerate(images):
-        base64_image = encode_image_for_api(image)
+    for i, (image, base64_image) in enumerate(zip(images, encoded_images)):
+        label = f"Figure {i+1} of {len(images)}:"
+        caption = getattr(image, "caption", None)
+        if caption:
+            label += f" (caption in document: \"{caption}\")"
         messages.append({
             "role": "user",
             "content": [
-                {"type": "text", "text": f"Figure {i+1} of {len(images)}:"},
+                {"type": "text", "text": label},
                 {
                     "type": "image_url",
                     "image_url": {
@@ -252,11 +827,620 @@ def analyze_images_with_gpt4_vision(images, module):
             messages=messages,
             max_tokens=3000
         )
+        record_usage(token_counts, response)
         return response.choices[0].message.content
     except Exception as e:
         return f"Error analyzing images: {e}"
 
 
+# ─────────────────────────────────────────────
+# Prior-module condensation
+# ─────────────────────────────────────────────
+#
+# The previously approved document is cut down to what the current module's
+# reviewer needs before it is prepended to the submission: sections whose
+# heading matches the module's profile are kept whole, other sections keep
+# only matching sentences and table rows, and reference lists are dropped.
+# Results are cached on the prior text, so Module 5's three parts and
+# reruns reuse one condensation.
+
+PRIOR_CONTEXT_PROFILES = {
+    # Prior: Module 2 (Research Questions)
+    "3 - Study Design": {
+        "headings": r"question|hypothes|aim|objective|purpose|rationale",
+        "sentences": r"question|hypothes|predict|\baim|objective|purpose|population|participant|intervention|outcome|variable|effect of",
+    },
+    # Prior: Module 3 (Study Design)
+    "4 - Human Research Ethics": {
+        "headings": r"question|hypothes|participant|population|sample|recruit|intervention|procedure|protocol|method|risk",
+        "sentences": r"question|hypothes|participant|population|subject|recruit|inclusion|exclusion|intervention|procedure|protocol|"
+                     r"dose|exercise|supplement|blood|sample|measure|risk|consent|\bage|healthy|pregnan|minor",
+    },
+    # Prior: Module 3 (Study Design)
+    "5 - Presenting Results": {
+        "headings": r"question|hypothes|variable|design|group|measure|outcome|statistic|analysis",
+        "sentences": r"question|hypothes|independent|dependent|variable|group|control|condition|measure|outcome|"
+                     r"statistic|test|compar|paired|unpaired|anova|repeated|baseline|n\s*=",
+    },
+    # Prior: Module 5 (Presenting Results)
+    "6 - Discussion Section": {
+        "headings": r"result|finding",
+        "sentences": r"\bp\s*[=<>]|signific|increas|decreas|no (significant )?difference|higher|lower|greater|"
+                     r"reduc|elevat|figure|fig\.|\bmean|±|change|trend",
+    },
+}
+REFERENCE_HEADING = re.compile(
+    r'^\s*(references?|reference list|bibliography|works cited|literature cited|citations)\s*:?\s*$', re.IGNORECASE
+)
+MIN_CONDENSED_WORDS = 60
+
+def _is_figure_line(line):
+    """True for [Figure N] markers and figure captions, which sit inside a section."""
+    return line.lstrip().startswith("[Figure") or bool(CAPTION_PATTERN.match(line))
+
+def _is_heading(line):
+    words = line.split()
+    return (0 < len(words) <= 10 and not line.rstrip().endswith(('.', ',', ';', ':', '?', ')'))
+            and "|" not in line and not _is_figure_line(line))
+
+def strip_reference_list(text):
+    """Drop everything from a References/Bibliography heading onward."""
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        if REFERENCE_HEADING.match(line):
+            return "\n".join(lines[:i]).rstrip()
+    return text
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def condense_prior_text(prior_text, module):
+    """Return {"text", "original_tokens", "condensed_tokens"} for the module's prior document.
+
+    Falls back to the full text minus references when the profile keeps
+    fewer than MIN_CONDENSED_WORDS words, so an unusual layout never loses
+    the context entirely.
+    """
+    without_refs = strip_reference_list(prior_text)
+    profile = PRIOR_CONTEXT_PROFILES.get(module)
+    condensed = without_refs
+    if profile is not None:
+        heading_pattern = re.compile(profile["headings"], re.IGNORECASE)
+        sentence_pattern = re.compile(profile["sentences"], re.IGNORECASE)
+        kept = []
+        keep_section = False
+        for line in without_refs.splitlines():
+            if not line.strip():
+                continue
+            if _is_figure_line(line):
+                # Figures never end a section; outside kept sections keep markers and matching captions
+                if keep_section or line.lstrip().startswith("[Figure") or sentence_pattern.search(line):
+                    kept.append(line.strip())
+            elif _is_heading(line):
+                keep_section = bool(heading_pattern.search(line))
+                kept.append(line.strip())
+            elif keep_section or " | " in line:
+                kept.append(line.strip())
+            else:
+                sentences = re.split(r'(?<=[.!?])\s+(?=[A-Z(\[])', line.strip())
+                matching = [sentence for sentence in sentences if sentence_pattern.search(sentence)]
+                if matching:
+                    kept.append(" ".join(matching))
+        # Drop headings left with nothing under them
+        kept = [line for i, line in enumerate(kept)
+                if not _is_heading(line) or (i + 1 < len(kept) and not _is_heading(kept[i + 1]))]
+        if len(" ".join(kept).split()) >= MIN_CONDENSED_WORDS:
+            condensed = "\n".join(kept)
+    return {
+        "text": condensed,
+        "original_tokens": count_tokens(prior_text),
+        "condensed_tokens": count_tokens(condensed),
+    }
+
+
+# ─────────────────────────────────────────────
+# Local citation store
+# ─────────────────────────────────────────────
+#
+# DOIs cited in past web-search reviews are checked against Crossref and
+# kept in the shared store with their title, abstract and the topic terms of the
+# submission that produced them. A BM25 index over that text lets a new
+# submission on a familiar topic get vetted citations locally: with enough
+# strong matches the web search is skipped, with a few it is narrowed to
+# what the local sources do not cover. A citation expires
+# CITATION_FRESHNESS_DAYS after it was first harvested, however often it is
+# cited again, so the library keeps drawing in new literature.
+
+# Parentheses are allowed when balanced, e.g. 10.1016/S0140-6736(20)30183-5
+DOI_PATTERN = re.compile(r'\b(10\.\d{4,9}/(?:[^\s"<>()\[\]]|\([^\s"<>()\[\]]*\))+)', re.IGNORECASE)
+STOPWORDS = set("""
+a about above after again against all also an and any are as at be because been before being below between
+both but by can could did do does doing during each few for from further had has have having how however if in
+into is it its itself more most no nor not of off on once only or other our out over own same should so some
+such than that the their them then there these they this those through to too under until up very was we were
+what when where which while who whom why will with would you your study studies students student group participants
+results research question figure table section module using used use may might also within
+""".split())
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+def tokenize(text):
+    return [word for word in re.findall(r'[a-z][a-z0-9\-]{2,}', text.lower()) if word not in STOPWORDS]
+
+def topic_terms(text, limit=40):
+    """The `limit` most frequent content words of a submission, used as its topic."""
+    counts = {}
+    for word in tokenize(text):
+        counts[word] = counts.get(word, 0) + 1
+    return [word for word, _ in sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]]
+
+def fetch_crossref_metadata(doi):
+    """Look a DOI up on Crossref; returns a metadata dict, or None if it does not exist."""
+    response = requests.get(
+        f"https://api.crossref.org/works/{urllib.parse.quote(doi)}",
+        headers={"User-Agent": "BIOC32-Peer-Review-Assistant"},
+        timeout=10
+    )
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    work = response.json()["message"]
+    date_parts = (work.get("issued") or {}).get("date-parts") or [[None]]
+    abstract = re.sub(r'<[^>]+>', ' ', work.get("abstract") or "")
+    return {
+        "title": " ".join(work.get("title") or []),
+        "abstract": html.unescape(" ".join(abstract.split())),
+        "journal": " ".join(work.get("container-title") or []),
+        "year": date_parts[0][0],
+    }
+
+@st.cache_resource
+def get_harvest_executor():
+    """A small pool of its own, so slow Crossref lookups never hold up review workers."""
+    return ThreadPoolExecutor(max_workers=CITATION_HARVEST_WORKERS, thread_name_prefix="harvest")
+
+def harvest_citations(feedback_text, submission_text, module, index):
+    """Store the Crossref-verified DOIs cited in a review; returns how many were stored.
+
+    DOIs that Crossref does not know are dropped, so invented citations never
+    become candidates. Runs in the background after the review is shown.
+    """
+    references = {}
+    for line in feedback_text.splitlines():
+        for match in DOI_PATTERN.finditer(line):
+            doi = match.group(1).rstrip('.,;:').lower()
+            references.setdefault(doi, line.strip(" -*\t"))
+    if not references:
+        return 0
+    topic = " ".join(topic_terms(submission_text))
+    now = datetime.now().isoformat()
+    store = get_store()
+    stored = 0
+    for doi, reference in references.items():
+        if store.touch_citation(doi, module, topic, now):
+            stored += 1
+            continue
+        try:
+            metadata = fetch_crossref_metadata(doi)
+        except Exception:
+            continue  # Crossref unreachable: try again next time this DOI is cited
+        if metadata is None:
+            continue
+        store.add_citation(dict(metadata, doi=doi, reference=reference, topic=topic, modules=module,
+                                harvested_at=now))
+        stored += 1
+    index.invalidate()
+    return stored
+
+
+class CitationIndex:
+    """In-memory BM25 index over the fresh rows of the citation store, rebuilt after harvests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = None
+
+    def invalidate(self):
+        with self._lock:
+            self._docs = None
+
+    def _load(self):
+        cutoff = (datetime.now() - timedelta(days=CITATION_FRESHNESS_DAYS)).isoformat()
+        rows = get_store().list_citations(cutoff)
+        docs = []
+        doc_freq = {}
+        for row in rows:
+            terms = {}
+            for word in tokenize(f"{row['title']} {row['abstract']} {row['reference']} {row['topic']}"):
+                terms[word] = terms.get(word, 0) + 1
+            for word in terms:
+                doc_freq[word] = doc_freq.get(word, 0) + 1
+            docs.append((row, terms, sum(terms.values())))
+        self._docs = docs
+        self._doc_freq = doc_freq
+        self._avg_len = sum(length for _, _, length in docs) / len(docs) if docs else 0
+        self._loaded_at = time.monotonic()
+
+    def search(self, query_terms, limit):
+        """Return up to `limit` (score, citation row) pairs, best first."""
+        with self._lock:
+            # Reload periodically too, so harvests from other replicas show up
+            if self._docs is None or time.monotonic() - self._loaded_at > 300:
+                self._load()
+            docs, doc_freq, avg_len = self._docs, self._doc_freq, self._avg_len
+        n = len(docs)
+        scored = []
+        for row, terms, length in docs:
+            score = 0.0
+            for word in query_terms:
+                tf = terms.get(word)
+                if not tf:
+                    continue
+                idf = math.log(1 + (n - doc_freq[word] + 0.5) / (doc_freq[word] + 0.5))
+                score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_len))
+            if score > 0:
+                scored.append((score, row))
+        scored.sort(key=lambda item: -item[0])
+        return scored[:limit]
+
+
+@st.cache_resource
+def get_citation_index():
+    return CitationIndex()
+
+
+def find_local_citations(index, submission_text):
+    """Return the fresh stored citations that strongly match a submission's topic."""
+    try:
+        matches = index.search(topic_terms(submission_text), CITATION_MAX_CANDIDATES)
+    except Exception:
+        return []  # a lookup failure only means a full web search
+    return [row for score, row in matches if score >= CITATION_MIN_SCORE]
+
+def format_citation(row):
+    parts = [row["title"] or row["reference"]]
+    if row["journal"]:
+        parts.append(row["journal"])
+    if row["year"]:
+        parts.append(str(row["year"]))
+    parts.append(f"https://doi.org/{row['doi']}")
+    return " — ".join(parts)
+
+
+# ─────────────────────────────────────────────
+# Per-group usage and quotas
+# ─────────────────────────────────────────────
+#
+# Every review is recorded in the shared store with the group, module,
+# number of API calls and tokens used, so every replica enforces the same
+# limits. Before a review starts the group must be outside its cooldown,
+# under its reviews-per-hour limit for the module and under its daily token
+# limit. With FAIR_SHARE_TOKENS_PER_HOUR set, that hourly budget is also
+# split evenly between the groups active in the last hour. The check and the
+# record of the new review happen in one store transaction. A review that
+# fails (e.g. an OpenAI error) does not count towards the cooldown or hourly
+# limit, but any tokens it used count towards the token limits.
+
+def _with_default_quota(overrides):
+    quota = {
+        "reviews_per_hour": QUOTA_REVIEWS_PER_HOUR,
+        "tokens_per_day": QUOTA_TOKENS_PER_DAY,
+        "cooldown_seconds": QUOTA_COOLDOWN_SECONDS,
+    }
+    quota.update(overrides)
+    return quota
+
+def get_group_quota(group_number):
+    return _with_default_quota(get_store().get_group_quota(group_number))
+
+def _format_wait(seconds):
+    minutes = math.ceil(seconds / 60)
+    return f"{minutes} minute{'s' if minutes != 1 else ''}"
+
+def check_quota(group_number, module, quota, stats, now):
+    """Return None if the group may start a review now, otherwise a message saying why not."""
+    last = stats["last_review"]
+    if quota["cooldown_seconds"] and last is not None and now - last < quota["cooldown_seconds"]:
+        return (f"Please wait {_format_wait(quota['cooldown_seconds'] - (now - last))} "
+                "before requesting another review.")
+
+    if quota["reviews_per_hour"] and stats["module_reviews_hour"] >= quota["reviews_per_hour"]:
+        return (f"Group {group_number} has used its {quota['reviews_per_hour']} reviews per hour for {module}. "
+                f"Please try again in {_format_wait(stats['first_module_review_hour'] + 3600 - now)}.")
+
+    if quota["tokens_per_day"] and stats["tokens_day"] >= quota["tokens_per_day"]:
+        return f"Group {group_number} has reached its daily review allowance. Please try again tomorrow."
+
+    if FAIR_SHARE_TOKENS_PER_HOUR:
+        active_groups = stats["active_groups_hour"] | {group_number}
+        if stats["tokens_hour"] >= FAIR_SHARE_TOKENS_PER_HOUR / len(active_groups):
+            return ("The reviewer is busy and your group has used its share for this hour. "
+                    "Please try again later.")
+    return None
+
+def start_usage(group_number, module):
+    """Check the group's quota and record the start of a review.
+
+    Returns (usage_id, None), or (None, message) when the quota refuses it.
+    """
+    return get_store().start_usage(
+        group_number, module,
+        lambda overrides, stats, now: check_quota(group_number, module, _with_default_quota(overrides), stats, now)
+    )
+
+def finish_usage(usage_id, token_counts, failed=False):
+    """Add the API calls and tokens collected in `token_counts` to a started review."""
+    get_store().finish_usage(usage_id, len(token_counts), sum(token_counts), failed)
+
+def record_usage(token_counts, response):
+    """Append a response's total token count to `token_counts` (a list shared by a review's stages)."""
+    if token_counts is not None:
+        token_counts.append(getattr(getattr(response, "usage", None), "total_tokens", 0) or 0)
+
+# ─────────────────────────────────────────────
+# Review pipelines
+# ─────────────────────────────────────────────
+#
+# Each module's review is a list of stages. A stage runs on the shared worker
+# pool as soon as the stages it depends on have finished, so the text review
+# starts immediately while figures are extracted, encoded and sent to the
+# vision model alongside it. Stages read the inputs and earlier results from
+# a single `ctx` dict and their result is stored in it under the stage name.
+
+@st.cache_resource
+def get_pipeline_executor():
+    return ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="review")
+
+
+class Stage:
+    """One step of a review pipeline.
+
+    `on_error`, if given, turns an exception raised by this stage (or by a
+    stage it depends on) into a fallback result instead of failing the review.
+    """
+
+    def __init__(self, name, run, after=(), label="", on_error=None):
+        self.name = name
+        self.run = run
+        self.after = tuple(after)
+        self.label = label or name
+        self.on_error = on_error
+
+
+def _run_stage(stage, ctx):
+    try:
+        return stage.run(ctx)
+    except Exception as e:
+        if stage.on_error is None:
+            raise
+        return stage.on_error(e)
+
+
+def run_pipeline(stages, inputs, on_stage_done=None):
+    """Run `stages` on the shared pipeline pool in dependency order and return the ctx dict.
+
+    Must be called from the script thread; `on_stage_done(stage)` is called
+    there as each stage finishes so it can update the page.
+    """
+    executor = get_pipeline_executor()
+    ctx = dict(inputs)
+    failed = {}
+    handled = set()  # ids of exceptions some stage's on_error has absorbed
+    pending = {stage.name: stage for stage in stages}
+    running = {}
+    while pending or running:
+        for name, stage in list(pending.items()):
+            failed_dep = next((dep for dep in stage.after if dep in failed), None)
+            if failed_dep is not None:
+                del pending[name]
+                if stage.on_error is None:
+                    failed[name] = failed[failed_dep]
+                else:
+                    handled.add(id(failed[failed_dep]))
+                    ctx[name] = stage.on_error(failed[failed_dep])
+                    if on_stage_done:
+                        on_stage_done(stage)
+            elif all(dep in ctx for dep in stage.after):
+                del pending[name]
+                running[executor.submit(_run_stage, stage, dict(ctx))] = stage
+        if not running:
+            if pending:
+                raise ValueError(f"Pipeline stages with unmet dependencies: {sorted(pending)}")
+            break
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            stage = running.pop(future)
+            try:
+                ctx[stage.name] = future.result()
+            except Exception as e:
+                failed[stage.name] = e
+                continue
+            if on_stage_done:
+                on_stage_done(stage)
+    for error in failed.values():
+        if id(error) not in handled:
+            raise error
+    return ctx
+
+
+def extract_response_text(response):
+    """Concatenate the text blocks of a Responses API result."""
+    text_feedback = ""
+    for block in response.output:
+        if hasattr(block, "content"):
+            for content_block in block.content:
+                if hasattr(content_block, "text"):
+                    text_feedback += content_block.text
+    return text_feedback or "No feedback was generated. Please try again."
+
+def review_with_web_search(instructions, combined_text, search_instruction, local_citations=(), token_counts=None):
+    """Review with the web search tool, narrowed or replaced by matching local citations."""
+    tools = [{"type": "web_search_preview"}]
+    if local_citations:
+        sources = "\n".join(f"- {format_citation(row)}" for row in local_citations)
+        if len(local_citations) >= CITATION_SKIP_MIN:
+            tools = []
+            search_instruction += (
+                "\n\nWeb search is not available for this review. Use the following verified, "
+                "peer-reviewed sources on this topic as your search results, and cite only from this list:\n"
+                f"{sources}"
+            )
+        else:
+            search_instruction += (
+                "\n\nThe following verified, peer-reviewed sources are closely related to this topic. "
+                "Cite any that are relevant, and only search the web for what they do not cover:\n"
+                f"{sources}"
+            )
+    response = openai.responses.create(
+        model="gpt-4o",
+        tools=tools,
+        instructions=instructions,
+        input=f"{combined_text}\n\n{search_instruction}"
+    )
+    record_usage(token_counts, response)
+    return extract_response_text(response)
+
+def review_with_chat(system_prompt, combined_text, token_counts=None):
+    response = openai.chat.completions.create(
+        model="gpt-4-turbo",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": combined_text}
+        ]
+    )
+    record_usage(token_counts, response)
+    return response.choices[0].message.content
+
+
+WEB_SEARCH_INSTRUCTIONS = {
+    "2 - Research Questions": (
+        "IMPORTANT: Before providing feedback, search the web for recent "
+        "peer-reviewed literature (2019–present) directly related to this "
+        "research question. Use your search results to: (1) assess whether "
+        "this question has already been answered, (2) provide 2–4 real, "
+        "specific citations (with authors, journal, year, and DOI or URL) "
+        "that students could read or cite, and (3) identify any factual "
+        "errors in the background the students have written."
+    ),
+    "3 - Study Design": (
+        "IMPORTANT: Search the web for 2-3 real published studies that used "
+        "a similar experimental design to the one proposed (similar intervention, "
+        "population, or outcome measures). Cite each study fully (authors, journal, "
+        "year, DOI) and explain specifically what the students can learn from it "
+        "to improve their design."
+    ),
+    "4 - Human Research Ethics": (
+        "IMPORTANT: Where the students have proposed mitigations or monitoring thresholds for harms, search the web for peer-reviewed literature (2019-present) that supports or challenges those thresholds and protocols. Embed relevant citations (authors, journal, year, DOI) directly within the specific issues where they strengthen or correct the students' rationale. Also search for any clinical guidelines or published safety protocols relevant to the study population or intervention described."
+    ),
+    "6 - Discussion Section": (
+        "IMPORTANT: Search the web for recent peer-reviewed literature (2019-present) relevant to the physiological mechanisms and findings discussed by the students. For each weakness you identify — particularly where mechanistic reasoning is shallow, a claim lacks support, or an interpretation could be strengthened — embed a real citation (authors, journal, year, DOI) that the students could use to deepen their discussion. Prioritise primary research articles and reviews that directly address the variables and population in the submission."
+    ),
+}
+
+
+def _figure_feedback(ctx):
+    images, encoded_images = ctx["encoded_images"]
+    if not images:
+        if ctx["images"]:
+            return (
+                "None of the figures in the document could be read. "
+                "Try re-inserting them as PNG or JPEG images."
+            )
+        return (
+            "No figures were found in the document. "
+            "If you have figures, make sure they are properly embedded "
+            f"in your {ctx['source_label']}."
+        )
+    return analyze_images_with_gpt4_vision(
+        images, ctx["image_prompt"], encoded_images, ctx["token_counts"]
+    )
+
+
+def web_search_pipeline(module, spinner):
+    return {
+        "spinner": spinner,
+        "rubrics": {"rubric_prompt": f"rubric_{module.split(' ')[0]}"},
+        "stages": [
+            Stage(
+                "local_citations",
+                lambda ctx: find_local_citations(ctx["citation_index"], ctx["full_text"]),
+                label="Citation library lookup",
+                on_error=lambda e: [],
+            ),
+            Stage(
+                "text_feedback",
+                lambda ctx: review_with_web_search(
+                    ctx["rubric_prompt"], ctx["combined_text"], WEB_SEARCH_INSTRUCTIONS[module],
+                    ctx["local_citations"], ctx["token_counts"]
+                ),
+                after=["local_citations"],
+                label="Content analysis",
+            ),
+        ],
+        "sections": [("### 📝 Content Analysis", "text_feedback")],
+        "layout": "markdown",
+        "included_figures": False,
+    }
+
+
+REVIEW_PIPELINES = {
+    "2 - Research Questions": web_search_pipeline(
+        "2 - Research Questions",
+        "Analyzing content and searching recent literature — this may take up to 30 seconds...",
+    ),
+    "3 - Study Design": web_search_pipeline(
+        "3 - Study Design",
+        "Analyzing study design and searching for comparable studies — this may take up to 30 seconds...",
+    ),
+    "4 - Human Research Ethics": web_search_pipeline(
+        "4 - Human Research Ethics",
+        "Analyzing ethics review and searching for supporting literature — this may take up to 30 seconds...",
+    ),
+    "5 - Presenting Results": {
+        "spinner": "Assessing statistical analysis, results text and figures...",
+        "rubrics": {"stats_prompt": "stats_rubric_5", "results_prompt": "results_rubric_5"},
+        "stages": [
+            Stage(
+                "stats_feedback",
+                lambda ctx: review_with_chat(ctx["stats_prompt"], ctx["combined_text"], ctx["token_counts"]),
+                label="Part 1: Statistical analysis",
+                on_error=lambda e: f"Statistical analysis assessment unavailable: {e}",
+            ),
+            Stage(
+                "results_text_feedback",
+                lambda ctx: review_with_chat(ctx["results_prompt"], ctx["combined_text"], ctx["token_counts"]),
+                label="Part 2: Results text",
+                on_error=lambda e: f"Results text assessment unavailable: {e}",
+            ),
+            Stage("images", lambda ctx: ctx["image_loader"]() if ctx["image_loader"] else [],
+                  label="Figure extraction"),
+            Stage("encoded_images", lambda ctx: encode_images_for_api(ctx["images"]),
+                  after=["images"], label="Figure encoding"),
+            Stage(
+                "image_feedback",
+                _figure_feedback,
+                after=["images", "encoded_images"],
+                label="Part 3: Figures",
+                on_error=lambda e: f"Figure assessment unavailable: {e}",
+            ),
+        ],
+        "sections": [
+            ("## 📊 Part 1: Statistical Analysis Assessment", "stats_feedback"),
+            ("## 📝 Part 2: Results Text Assessment", "results_text_feedback"),
+            ("## 🖼️ Part 3: Figure Assessment", "image_feedback"),
+        ],
+        "layout": "expanders",
+        "included_figures": True,
+    },
+    "6 - Discussion Section": web_search_pipeline(
+        "6 - Discussion Section",
+        "Analyzing discussion and searching for relevant literature — this may take up to 30 seconds...",
+    ),
+}
+
+
+# Every prompt a pipeline sends, checked by RubricRegistry.refresh
+REQUIRED_RUBRICS = sorted({name for pipeline in REVIEW_PIPELINES.values() for name in pipeline["rubrics"].values()})
+
+
 # ─────────────────────────────────────────────
 # Admin panel
 # ─────────────────────────────────────────────
@@ -281,38 +1465,120 @@ def admin_panel():
 
     submissions = load_submissions()
 
+    # Usage, quotas, rubrics and export below stay available with no submissions
     if not submissions:
         st.info("No submissions found.")
-        if st.button("🚪 Logout", type="secondary"):
-            st.session_state.admin_authenticated = False
-            st.rerun()
-        return
+    else:
+        st.subheader("📊 Submission Statistics")
+        stats = get_submission_stats(submissions)
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Total Submissions", stats["total"])
+        with col2:
+            st.metric("Unique Groups", stats["unique_groups"])
+        with col3:
+            st.metric("Modules with Submissions", stats["modules_with_submissions"])
+
+        st.subheader("📋 Submissions by Module")
+        modules_data = get_submissions_by_module(submissions)
+        for module in sorted(modules_data.keys()):
+            module_submissions = modules_data[module]
+            with st.expander(f"{module} ({len(module_submissions)} submissions)"):
+                for i, submission in enumerate(module_submissions):
+                    col1, col2, col3 = st.columns([2, 2, 2])
+                    with col1:
+                        st.write(f"**Group:** {submission.get('groupnumber', 'N/A')}")
+                    with col2:
+                        st.write(f"**Time:** {format_timestamp(submission.get('timestamp', ''))}")
+                    with col3:
+                        st.write(f"**Figures:** {submission.get('included_figures', 'N/A')}")
+                    if i < len(module_submissions) - 1:
+                        st.divider()
+
+    st.subheader("📈 Submission Activity")
+    rollups = rollups_to_frame(get_store().rollups())
+    if rollups.empty:
+        st.info("No timestamped submissions to chart yet.")
+    else:
+        hourly = rollups.pivot_table(index="hour", columns="module", values="count", aggfunc="sum", fill_value=0)
+        st.write("**Submissions per hour:**")
+        st.bar_chart(hourly)
+
+        st.write("**Submissions in the hours before a deadline:**")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            deadline_date = st.date_input("Deadline date:", value=rollups["hour"].max().date(), key="deadline_date")
+        with col2:
+            deadline_time = st.time_input("Deadline time:", value=datetime.strptime("23:59", "%H:%M").time(), key="deadline_time")
+        with col3:
+            window_hours = st.number_input("Hours before deadline:", min_value=1, max_value=336, value=72, key="deadline_window")
+        deadline = datetime.combine(deadline_date, deadline_time)
+        hours_before = (rollups["hour"] - deadline) / pd.Timedelta(hours=1)
+        window = rollups[(hours_before > -window_hours) & (hours_before <= 0)].copy()
+        if window.empty:
+            st.info("No submissions in that window.")
+        else:
+            window["hours_to_deadline"] = hours_before[window.index].apply(lambda h: int(h // 1))
+            before_deadline = window.pivot_table(
+                index="hours_to_deadline", columns="module", values="count", aggfunc="sum", fill_value=0
+            )
+            st.bar_chart(before_deadline)
+            busiest = window.groupby("groupnumber")["count"].sum().sort_values(ascending=False).head(10)
+            st.write("**Most active groups in this window:**")
+            st.dataframe(busiest.rename("submissions"))
+
+    st.subheader("👥 Usage & Quotas")
+    usage_window = st.radio("Usage window:", ["Last hour", "Last 24 hours", "Last 7 days"], horizontal=True)
+    window_seconds = {"Last hour": 3600, "Last 24 hours": 86400, "Last 7 days": 7 * 86400}[usage_window]
+    usage_rows = get_store().usage_summary(time.time() - window_seconds)
+    if usage_rows:
+        for row in usage_rows:
+            row["last_review"] = datetime.fromtimestamp(row["last_review"]).strftime('%Y-%m-%d %H:%M:%S')
+        st.dataframe(usage_rows, hide_index=True)
+    else:
+        st.info("No reviews in this window.")
+    st.caption(
+        f"Defaults: {QUOTA_REVIEWS_PER_HOUR} reviews per module per hour, {QUOTA_TOKENS_PER_DAY:,} tokens per day, "
+        f"{QUOTA_COOLDOWN_SECONDS}s cooldown (0 = unlimited)."
+        + (f" Fair share: {FAIR_SHARE_TOKENS_PER_HOUR:,} tokens per hour split across active groups."
+           if FAIR_SHARE_TOKENS_PER_HOUR else "")
+    )
 
-    st.subheader("📊 Submission Statistics")
-    stats = get_submission_stats(submissions)
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        st.metric("Total Submissions", stats["total"])
-    with col2:
-        st.metric("Unique Groups", stats["unique_groups"])
-    with col3:
-        st.metric("Modules with Submissions", stats["modules_with_submissions"])
-
-    st.subheader("📋 Submissions by Module")
-    modules_data = get_submissions_by_module(submissions)
-    for module in sorted(modules_data.keys()):
-        module_submissions = modules_data[module]
-        with st.expander(f"{module} ({len(module_submissions)} submissions)"):
-            for i, submission in enumerate(module_submissions):
-                col1, col2, col3 = st.columns([2, 2, 2])
-                with col1:
-                    st.write(f"**Group:** {submission.get('groupnumber', 'N/A')}")
-                with col2:
-                    st.write(f"**Time:** {format_timestamp(submission.get('timestamp', ''))}")
-                with col3:
-                    st.write(f"**Figures:** {submission.get('included_figures', 'N/A')}")
-                if i < len(module_submissions) - 1:
-                    st.divider()
+    quota_group = st.text_input("Group number to adjust:", key="quota_group").strip()
+    if quota_group:
+        current_quota = get_group_quota(quota_group)
+        # Keyed per group: a keyed number_input ignores later changes to `value`
+        quota_keys = [f"quota_{field}_{quota_group}" for field in ("reviews", "tokens", "cooldown")]
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            reviews_per_hour = st.number_input("Reviews per module per hour", min_value=0,
+                                               value=current_quota["reviews_per_hour"], key=quota_keys[0])
+        with col2:
+            tokens_per_day = st.number_input("Tokens per day", min_value=0, step=10000,
+                                             value=current_quota["tokens_per_day"], key=quota_keys[1])
+        with col3:
+            cooldown_seconds = st.number_input("Cooldown (seconds)", min_value=0,
+                                               value=current_quota["cooldown_seconds"], key=quota_keys[2])
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            if st.button("💾 Save Quota"):
+                if apply_admin_edit(get_store().set_group_quota, quota_group, {
+                    "reviews_per_hour": int(reviews_per_hour),
+                    "tokens_per_day": int(tokens_per_day),
+                    "cooldown_seconds": int(cooldown_seconds),
+                }):
+                    st.success(f"Quota for Group {quota_group} updated!")
+        with col2:
+            if st.button("♻️ Reset Usage"):
+                if apply_admin_edit(get_store().reset_group_usage, quota_group):
+                    st.success(f"Usage for Group {quota_group} reset!")
+        with col3:
+            if st.button("↩️ Restore Default Quota"):
+                if apply_admin_edit(get_store().clear_group_quota, quota_group):
+                    for key in quota_keys:
+                        st.session_state.pop(key, None)  # show the defaults after the rerun
+                    st.success(f"Group {quota_group} restored to the default quota!")
+                    st.rerun()
 
     st.subheader("🛠️ Management Options")
     col1, col2 = st.columns(2)
@@ -321,11 +1587,11 @@ def admin_panel():
         st.write("**Remove specific submission:**")
         if submissions:
             selection_options = []
-            for i, submission in enumerate(submissions):
+            for submission in submissions:
                 display_text = f"Group {submission.get('groupnumber', 'N/A')} - {submission.get('module', 'N/A')} ({format_timestamp(submission.get('timestamp', ''))})"
-                selection_options.append((i, display_text))
+                selection_options.append((submission['id'], display_text))
 
-            selected_index = st.selectbox(
+            selected_id = st.selectbox(
                 "Select submission to remove:",
                 options=[opt[0] for opt in selection_options],
                 format_func=lambda x: next(opt[1] for opt in selection_options if opt[0] == x)
@@ -339,8 +1605,7 @@ def admin_panel():
                     st.warning("Click again to confirm removal.")
                     st.rerun()
                 else:
-                    updated_submissions = [sub for i, sub in enumerate(submissions) if i != selected_index]
-                    if save_submissions(updated_submissions):
+                    if apply_admin_edit(get_store().remove_submission, selected_id):
                         st.success("Submission removed successfully!")
                         st.session_state.confirm_single_removal = False
                         st.rerun()
@@ -348,14 +1613,7 @@ def admin_panel():
     with col2:
         st.write("**Reset specific group/module:**")
         reset_group = st.text_input("Group number to reset:")
-        reset_module = st.selectbox("Module to reset:", [
-            "All modules",
-            "2 - Research Questions",
-            "3 - Study Design",
-            "4 - Human Research Ethics",
-            "5 - Presenting Results",
-            "6 - Discussion Section"
-        ])
+        reset_module = st.selectbox("Module to reset:", ["All modules"] + MODULES)
 
         if st.button("🔄 Reset Group Submissions", type="secondary"):
             if not reset_group:
@@ -372,14 +1630,12 @@ def admin_panel():
                     st.rerun()
                 else:
                     if reset_module == "All modules":
-                        updated_submissions = [sub for sub in submissions if sub.get('groupnumber', '') != reset_group]
+                        edit_args = (reset_group,)
                         success_msg = f"All submissions for Group {reset_group} removed!"
                     else:
-                        updated_submissions = [sub for sub in submissions
-                                             if not (sub.get('groupnumber', '') == reset_group and
-                                                   sub.get('module', '') == reset_module)]
+                        edit_args = (reset_group, reset_module)
                         success_msg = f"Group {reset_group}'s submission for {reset_module} removed!"
-                    if save_submissions(updated_submissions):
+                    if apply_admin_edit(get_store().remove_group_submissions, *edit_args):
                         st.success(success_msg)
                         st.session_state.confirm_group_reset = False
                         st.rerun()
@@ -390,27 +1646,51 @@ def admin_panel():
         confirm_text = st.text_input("Type 'RESET ALL' to confirm:")
         if st.button("🚨 RESET ALL SUBMISSIONS", type="primary"):
             if confirm_text == "RESET ALL":
-                if save_submissions([]):
+                if apply_admin_edit(get_store().reset_all):
                     st.success("All submissions have been reset!")
                     st.rerun()
             else:
                 st.error("Please type 'RESET ALL' to confirm.")
 
+    st.subheader("📚 Rubrics")
+    registry = get_rubric_registry()
+    if st.button("🔄 Reload rubrics now"):
+        registry.refresh(force=True)
+    for problem in registry.problems:
+        st.warning(problem)
+    st.dataframe(
+        [
+            {"Prompt": r["name"], "Version": r["version"], "Tokens": r["tokens"], "Loaded": r["loaded_at"],
+             "Sent": r["name"] in REQUIRED_RUBRICS or r["name"].startswith("image_rubric_")}
+            for r in sorted(registry.rubrics.values(), key=lambda r: r["name"])
+        ],
+        hide_index=True
+    )
+
     st.subheader("📥 Export Data")
-    if submissions:
-        output = io.StringIO()
-        fieldnames = ["timestamp", "module", "groupnumber", "included_figures"]
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
-        writer.writeheader()
-        for submission in submissions:
-            writer.writerow(submission)
-        csv_data = output.getvalue()
-        st.download_button(
-            label="📥 Download Submission Data (CSV)",
-            data=csv_data,
-            file_name=f"submissions_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-            mime="text/csv"
-        )
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        export_range = st.date_input("Date range:", value=(), key="export_range")
+    with col2:
+        export_modules = st.multiselect("Modules:", MODULES, key="export_modules")
+    with col3:
+        export_format = st.radio("Format:", ["CSV", "Parquet"], horizontal=True, key="export_format")
+
+    if st.button("📦 Prepare Export"):
+        start_date = export_range[0] if len(export_range) > 0 else None
+        end_date = export_range[1] if len(export_range) > 1 else start_date
+        file_format = export_format.lower()
+        path = export_submissions(file_format, start_date, end_date, export_modules)
+        try:
+            with open(path, 'rb') as file:
+                st.download_button(
+                    label=f"📥 Download Submission Data ({export_format})",
+                    data=file,
+                    file_name=f"submissions_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{file_format}",
+                    mime="text/csv" if file_format == "csv" else "application/vnd.apache.parquet"
+                )
+        finally:
+            os.remove(path)
 
     if st.button("🚪 Logout", type="secondary"):
         st.session_state.admin_authenticated = False
@@ -423,10 +1703,19 @@ def admin_panel():
 
 # ── Helper: read text (and optionally images) from any supported source ──
 def read_document(file_obj=None, file_type="docx", analyze_figures=False, key_prefix=""):
-    """Read text and images from a docx, pdf, or return None if nothing provided."""
+    """Read text from a docx, pdf, or Google Doc, or return None if nothing provided.
+
+    Returns (full_text, image_loader, source_label, digest), where `digest`
+    is the sha256 of the document's bytes.
+
+    Figures are returned as `image_loader`, a zero-argument callable that
+    yields the document's ImageHandles (None unless `analyze_figures`), so
+    extraction can run on the review pipeline's worker pool.
+    """
     full_text = None
-    images = []
+    image_loader = None
     source_label = ""
+    digest = ""
 
     tab_docx, tab_pdf, tab_gdoc = st.tabs([
         "📄 Upload Word (.docx)",
@@ -442,13 +1731,20 @@ def read_document(file_obj=None, file_type="docx", analyze_figures=False, key_pr
         )
         if uploaded_docx:
             try:
-                doc = Document(uploaded_docx)
-                full_text = "\n".join([para.text for para in doc.paragraphs])
+                upload = spool_upload(uploaded_docx, slot=f"{key_prefix}_docx", suffix=".docx")
+                doc = Document(upload.open())
+                full_text, figures = extract_docx_content(doc, analyze_figures)
                 if analyze_figures:
-                    images = extract_images_from_docx(doc)
+                    image_loader = lambda figures=figures: figures
                 source_label = "Word document"
+                digest = upload.digest
+            except DocumentTooLargeError as e:
+                st.error(str(e))
             except Exception as e:
                 st.error(f"Could not read Word file: {e}")
+        # The text and figures are extracted (and the file re-spooled on every rerun), so the
+        # spool is not kept; it is released here on success, failure or when the file is cleared
+        release_upload(f"{key_prefix}_docx")
 
     with tab_pdf:
         st.info(
@@ -460,20 +1756,27 @@ def read_document(file_obj=None, file_type="docx", analyze_figures=False, key_pr
             type="pdf",
             key=f"{key_prefix}_pdf"
         )
+        keep_pdf = False
         if uploaded_pdf:
             try:
-                pdf_bytes = io.BytesIO(uploaded_pdf.read())
-                full_text = extract_text_from_pdf(pdf_bytes)
+                upload = spool_upload(uploaded_pdf, slot=f"{key_prefix}_pdf", suffix=".pdf")
+                full_text = extract_text_from_pdf(upload)
                 if not full_text.strip():
                     st.error("No text could be extracted from this PDF. It may be a scanned image. Please upload a Word file instead.")
                     full_text = None
                 else:
                     source_label = "PDF"
+                    digest = upload.digest
                     if analyze_figures:
-                        pdf_bytes.seek(0)
-                        images = extract_images_from_pdf(pdf_bytes)
+                        image_loader = lambda upload=upload: extract_images_from_pdf(upload)
+                        keep_pdf = True
+            except DocumentTooLargeError as e:
+                st.error(str(e))
             except Exception as e:
                 st.error(f"Could not read PDF: {e}")
+        if not keep_pdf:
+            # Kept only for the figure loader, which reads it during the review
+            release_upload(f"{key_prefix}_pdf")
 
     with tab_gdoc:
         st.info(
@@ -494,19 +1797,22 @@ def read_document(file_obj=None, file_type="docx", analyze_figures=False, key_pr
             else:
                 try:
                     with st.spinner("Importing from Google Docs..."):
-                        docx_bytes = fetch_gdoc_as_docx(doc_id)
-                        doc = Document(docx_bytes)
-                        full_text = "\n".join([para.text for para in doc.paragraphs])
+                        upload = fetch_gdoc_as_docx(doc_id, slot=f"{key_prefix}_gdoc")
+                        doc = Document(upload.open())
+                        full_text, figures = extract_docx_content(doc, analyze_figures)
                         if analyze_figures:
-                            images = extract_images_from_docx(doc)
+                            image_loader = lambda figures=figures: figures
                         source_label = "Google Doc"
+                        digest = upload.digest
                         st.success("Google Doc imported successfully!")
-                except PermissionError as e:
+                except (PermissionError, DocumentTooLargeError) as e:
                     st.error(str(e))
                 except Exception as e:
                     st.error(f"Could not import Google Doc: {e}")
+                finally:
+                    release_upload(f"{key_prefix}_gdoc")
 
-    return full_text, images, source_label
+    return full_text, image_loader, source_label, digest
 
 
 def main_app():
@@ -518,13 +1824,11 @@ def main_app():
     )
 
     # ── Module selection ──
-    module = st.selectbox("Select Module", [
-        "2 - Research Questions",
-        "3 - Study Design",
-        "4 - Human Research Ethics",
-        "5 - Presenting Results",
-        "6 - Discussion Section"
-    ])
+    module = st.selectbox("Select Module", MODULES)
+    group_number = st.text_input("Group number", key="group_number", placeholder="e.g. 12").strip()
+    if group_number and not group_number.isdigit():
+        st.error("Please enter your group number using digits only.")
+        group_number = ""
 
     analyze_figures = (module == "5 - Presenting Results")
 
@@ -559,14 +1863,14 @@ def main_app():
     if needs_prior:
         _, prior_label = prior_module_map[module]
         st.markdown(f"### Step 1: Upload your approved {prior_label} submission")
-        prior_text, _, _ = read_document(key_prefix="prior", analyze_figures=False)
+        prior_text, _, _, _ = read_document(key_prefix="prior", analyze_figures=False)
         if prior_text is None:
             st.warning(f"⚠️ You must upload your approved {prior_label} submission before the reviewer can analyze your current module.")
 
     # ── Current module upload ──
     if needs_prior:
         st.markdown(f"### Step 2: Upload your {friendly_module_name[module]} submission")
-    full_text, images, source_label = read_document(key_prefix="current", analyze_figures=analyze_figures)
+    full_text, image_loader, source_label, document_digest = read_document(key_prefix="current", analyze_figures=analyze_figures)
 
     # ── Block if prior module missing ──
     if needs_prior and full_text and prior_text is None:
@@ -579,226 +1883,138 @@ def main_app():
             st.warning("The document appears to be empty. Please check your file and try again.")
         else:
             # Combine prior + current text for the API
+            condensed_prior = None
             if needs_prior and prior_text:
                 _, prior_label = prior_module_map[module]
+                condensed_prior = condense_prior_text(prior_text, module)
                 combined_text = (
-                    f"=== PREVIOUSLY APPROVED SUBMISSION: {prior_label} ===\n"
-                    f"{prior_text}\n\n"
+                    f"=== PREVIOUSLY APPROVED SUBMISSION: {prior_label} "
+                    "(condensed to the parts relevant to this module) ===\n"
+                    f"{condensed_prior['text']}\n\n"
                     f"=== CURRENT SUBMISSION UNDER REVIEW: {module} ===\n"
                     f"{full_text}"
                 )
             else:
                 combined_text = full_text
 
-            # ── Load rubric ──
-            rubric_file_path = f"prompts/rubric_{module.split(' ')[0]}.txt"
-            try:
-                with open(rubric_file_path, 'r', encoding='utf-8') as f:
-                    rubric_prompt = f.read()
-            except FileNotFoundError:
+            # ── Load the prompts this module's review sends ──
+            pipeline = REVIEW_PIPELINES[module]
+            registry = get_rubric_registry()
+            rubrics = {key: registry.get(name) for key, name in pipeline["rubrics"].items()}
+            if any(rubric is None for rubric in rubrics.values()):
                 st.error("Rubric prompt file not found. Please check the prompts directory.")
                 st.stop()
-
-            # ── Module 5: three separate API calls for three distinct feedback sections ──
-            if module == "5 - Presenting Results":
-                stats_feedback = ""
-                results_text_feedback = ""
-                image_feedback = ""
-
-                # ── Part 1: Statistical Analysis Assessment ──
-                stats_rubric = (
-                    "You are a peer reviewer for a third-year human physiology course. "
-                    "Your task is ONLY to assess the statistical analysis used in this submission. "
-                    "Produce a clearly labelled section titled \'## Part 1: Statistical Analysis Assessment\'. "
-                    "You must: (1) identify which statistical test(s) were used; "
-                    "(2) give an explicit verdict — APPROPRIATE or NOT APPROPRIATE — for each test; "
-                    "(3) explain your reasoning considering data type, distribution, group structure (paired/unpaired, 2-group vs multi-group); "
-                    "(4) if not appropriate, name the correct alternative and explain why in 1-2 sentences; "
-                    "(5) if no test is mentioned, state this clearly as a major problem and direct students "
-                    "to the Data Visualization and Analysis Tool on the Quercus page for this course. "
-                    "Do not comment on writing style, figures, or anything other than the statistical approach."
-                )
-                try:
-                    with st.spinner("Part 1 of 3: Assessing statistical analysis..."):
-                        r1 = openai.chat.completions.create(
-                            model="gpt-4-turbo",
-                            messages=[
-                                {"role": "system", "content": stats_rubric},
-                                {"role": "user", "content": combined_text}
-                            ]
-                        )
-                        stats_feedback = r1.choices[0].message.content
-                except Exception as e:
-                    stats_feedback = f"Statistical analysis assessment unavailable: {e}"
-
-                # ── Part 2: Results Text Assessment ──
-                results_rubric = (
-                    "You are a peer reviewer for a third-year human physiology course. "
-                    "Your task is ONLY to assess the written Results text (not figures, not stats methods). "
-                    "Produce a clearly labelled section titled \'## Part 2: Results Text Assessment\'. "
-                    "Evaluate whether the Results text: "
-                    "(1) adequately guides the reader through the main findings in a logical order; "
-                    "(2) describes trends and directions clearly (e.g., increased, decreased, no change) without repeating exact numeric values already shown in figures; "
-                    "(3) uses correct statistical language — significant findings reported as \'significantly higher/lower (P = 0.xxx)\', "
-                    "non-significant findings as \'no significant difference (P = 0.xxx)\'; "
-                    "(4) avoids mechanistic interpretation (that belongs in the Discussion); "
-                    "(5) references each figure at the appropriate point in the narrative. "
-                    "For each issue: quote the relevant sentence, explain the problem, and provide a suggested rewrite. "
-                    "If the results text is well-written, say so explicitly and identify what it does well. "
-                    "Do not comment on figures or statistical test choice — only the prose."
+            rubric_versions = [rubric["version"] for rubric in rubrics.values()]
+            image_prompt = DEFAULT_IMAGE_PROMPT
+            if analyze_figures:
+                image_rubric = registry.get_image_rubric(module)
+                if image_rubric is not None:
+                    image_prompt = image_rubric["text"]
+                    rubric_versions.append(image_rubric["version"])
+            rubric_version = "+".join(rubric_versions)
+
+            # ── Budget the largest request before sending it ──
+            request_tokens = max(rubric["tokens"] for rubric in rubrics.values()) + count_tokens(combined_text)
+            if request_tokens > MAX_REQUEST_TOKENS:
+                st.error(
+                    f"This submission is too long to review (about {request_tokens:,} tokens; "
+                    f"the limit is {MAX_REQUEST_TOKENS:,}). Please check that you uploaded the right documents."
                 )
-                try:
-                    with st.spinner("Part 2 of 3: Assessing results text..."):
-                        r2 = openai.chat.completions.create(
-                            model="gpt-4-turbo",
-                            messages=[
-                                {"role": "system", "content": results_rubric},
-                                {"role": "user", "content": combined_text}
-                            ]
-                        )
-                        results_text_feedback = r2.choices[0].message.content
-                except Exception as e:
-                    results_text_feedback = f"Results text assessment unavailable: {e}"
-
-                # ── Part 3: Figure Assessment ──
-                try:
-                    with st.spinner("Part 3 of 3: Assessing figures..."):
-                        if images:
-                            st.success(f"Found {len(images)} figure(s) in the document.")
-                            image_feedback = analyze_images_with_gpt4_vision(images, module)
-                        else:
-                            image_feedback = (
-                                "No figures were found in the document. "
-                                "If you have figures, make sure they are properly embedded "
-                                f"in your {source_label}."
-                            )
-                except Exception as e:
-                    image_feedback = f"Figure assessment unavailable: {e}"
+                st.stop()
 
-                # ── Log and display ──
-                log_submission(module, "N/A", True)
-                st.success("✅ Submission Successfully Reviewed. See Feedback Below.")
-                st.subheader("Peer Review Feedback")
+            # The document digest covers figures, which the text only marks as [Figure N]
+            review_key = hashlib.sha256(
+                f"{group_number}\0{module}\0{rubric_version}\0{document_digest}\0{combined_text}".encode('utf-8')
+            ).hexdigest()
+            review = get_store().get_review(review_key)
 
-                with st.expander("## 📊 Part 1: Statistical Analysis Assessment", expanded=True):
-                    st.write(stats_feedback)
+            if review is None:
+                if not group_number:
+                    st.warning("Please enter your group number above to receive feedback.")
+                    st.stop()
+                usage_id, quota_message = start_usage(group_number, module)
+                if quota_message:
+                    st.error(f"⏳ {quota_message}")
+                    st.stop()
 
-                with st.expander("## 📝 Part 2: Results Text Assessment", expanded=True):
-                    st.write(results_text_feedback)
+                # ── Run the module's review pipeline ──
+                token_counts = []
+                inputs = {
+                    "module": module,
+                    "combined_text": combined_text,
+                    "full_text": full_text,
+                    "citation_index": get_citation_index(),
+                    **{key: rubric["text"] for key, rubric in rubrics.items()},
+                    "image_prompt": image_prompt,
+                    "image_loader": image_loader,
+                    "source_label": source_label,
+                    "token_counts": token_counts,
+                }
+                progress = st.empty()
+                finished = []
 
-                with st.expander("## 🖼️ Part 3: Figure Assessment", expanded=True):
-                    st.write(image_feedback)
+                def show_progress(stage):
+                    finished.append(stage.label)
+                    progress.caption("Finished: " + ", ".join(finished))
 
-            else:
-                # ── All other modules: single API call ──
-                image_feedback = ""
+                failed = True
                 try:
-                    if module == "2 - Research Questions":
-                        with st.spinner("Analyzing content and searching recent literature — this may take up to 30 seconds..."):
-                            response = openai.responses.create(
-                                model="gpt-4o",
-                                tools=[{"type": "web_search_preview"}],
-                                instructions=rubric_prompt,
-                                input=(
-                                    f"{combined_text}\n\n"
-                                    "IMPORTANT: Before providing feedback, search the web for recent "
-                                    "peer-reviewed literature (2019–present) directly related to this "
-                                    "research question. Use your search results to: (1) assess whether "
-                                    "this question has already been answered, (2) provide 2–4 real, "
-                                    "specific citations (with authors, journal, year, and DOI or URL) "
-                                    "that students could read or cite, and (3) identify any factual "
-                                    "errors in the background the students have written."
-                                )
-                            )
-                            text_feedback = ""
-                            for block in response.output:
-                                if hasattr(block, "content"):
-                                    for content_block in block.content:
-                                        if hasattr(content_block, "text"):
-                                            text_feedback += content_block.text
-                            if not text_feedback:
-                                text_feedback = "No feedback was generated. Please try again."
-                    elif module == "3 - Study Design":
-                        with st.spinner("Analyzing study design and searching for comparable studies — this may take up to 30 seconds..."):
-                            response = openai.responses.create(
-                                model="gpt-4o",
-                                tools=[{"type": "web_search_preview"}],
-                                instructions=rubric_prompt,
-                                input=(
-                                    f"{combined_text}\n\n"
-                                    "IMPORTANT: Search the web for 2-3 real published studies that used "
-                                    "a similar experimental design to the one proposed (similar intervention, "
-                                    "population, or outcome measures). Cite each study fully (authors, journal, "
-                                    "year, DOI) and explain specifically what the students can learn from it "
-                                    "to improve their design."
-                                )
-                            )
-                            text_feedback = ""
-                            for block in response.output:
-                                if hasattr(block, "content"):
-                                    for content_block in block.content:
-                                        if hasattr(content_block, "text"):
-                                            text_feedback += content_block.text
-                            if not text_feedback:
-                                text_feedback = "No feedback was generated. Please try again."
-                    elif module == "4 - Human Research Ethics":
-                        with st.spinner("Analyzing ethics review and searching for supporting literature — this may take up to 30 seconds..."):
-                            response = openai.responses.create(
-                                model="gpt-4o",
-                                tools=[{"type": "web_search_preview"}],
-                                instructions=rubric_prompt,
-                                input=(
-                                    f"{combined_text}\n\n"
-                                    "IMPORTANT: Where the students have proposed mitigations or monitoring thresholds for harms, search the web for peer-reviewed literature (2019-present) that supports or challenges those thresholds and protocols. Embed relevant citations (authors, journal, year, DOI) directly within the specific issues where they strengthen or correct the students' rationale. Also search for any clinical guidelines or published safety protocols relevant to the study population or intervention described."
-                                )
-                            )
-                            text_feedback = ""
-                            for block in response.output:
-                                if hasattr(block, "content"):
-                                    for content_block in block.content:
-                                        if hasattr(content_block, "text"):
-                                            text_feedback += content_block.text
-                            if not text_feedback:
-                                text_feedback = "No feedback was generated. Please try again."
-                    elif module == "6 - Discussion Section":
-                        with st.spinner("Analyzing discussion and searching for relevant literature — this may take up to 30 seconds..."):
-                            response = openai.responses.create(
-                                model="gpt-4o",
-                                tools=[{"type": "web_search_preview"}],
-                                instructions=rubric_prompt,
-                                input=(
-                                    f"{combined_text}\n\n"
-                                    "IMPORTANT: Search the web for recent peer-reviewed literature (2019-present) relevant to the physiological mechanisms and findings discussed by the students. For each weakness you identify — particularly where mechanistic reasoning is shallow, a claim lacks support, or an interpretation could be strengthened — embed a real citation (authors, journal, year, DOI) that the students could use to deepen their discussion. Prioritise primary research articles and reviews that directly address the variables and population in the submission."
-                                )
-                            )
-                            text_feedback = ""
-                            for block in response.output:
-                                if hasattr(block, "content"):
-                                    for content_block in block.content:
-                                        if hasattr(content_block, "text"):
-                                            text_feedback += content_block.text
-                            if not text_feedback:
-                                text_feedback = "No feedback was generated. Please try again."
-                    else:
-                        with st.spinner("Analyzing content..."):
-                            response = openai.chat.completions.create(
-                                model="gpt-4-turbo",
-                                messages=[
-                                    {"role": "system", "content": rubric_prompt},
-                                    {"role": "user", "content": combined_text}
-                                ]
-                            )
-                            text_feedback = response.choices[0].message.content
+                    with st.spinner(pipeline["spinner"]):
+                        results = run_pipeline(pipeline["stages"], inputs, on_stage_done=show_progress)
+                    failed = False
                 except Exception as e:
                     st.error(f"OpenAI API error: {e}")
                     st.stop()
-
-                # ── Log and display ──
-                log_submission(module, "N/A", False)
-                st.success("✅ Submission Successfully Reviewed. See Feedback Below.")
-                st.subheader("Peer Review Feedback")
-                st.markdown("### 📝 Content Analysis")
-                st.write(text_feedback)
+                finally:
+                    finish_usage(usage_id, token_counts, failed)
+                progress.empty()
+                # A review that skipped web search could only cite the local sources, so
+                # harvesting it would keep refreshing the same set
+                if module in WEB_SEARCH_INSTRUCTIONS and len(results["local_citations"]) < CITATION_SKIP_MIN:
+                    get_harvest_executor().submit(
+                        harvest_citations, results["text_feedback"], full_text, module, results["citation_index"]
+                    )
+
+                log_submission(module, group_number, pipeline["included_figures"], rubric_version)
+                # Keep the feedback so reruns (any widget change, on any replica) show it
+                # again without a new review
+                readable_images, _ = results.get("encoded_images") or ([], [])
+                review = {
+                    "sections": [(heading, results[result_key]) for heading, result_key in pipeline["sections"]],
+                    "figure_count": len(readable_images),
+                    "unreadable_figure_count": len(results.get("images") or []) - len(readable_images),
+                    "local_citation_count": len(results.get("local_citations") or []),
+                }
+                get_store().save_review(review_key, review)
+
+            # ── Display ──
+            st.success("✅ Submission Successfully Reviewed. See Feedback Below.")
+            if review["figure_count"]:
+                st.success(f"Found {review['figure_count']} figure(s) in the document.")
+            if review.get("unreadable_figure_count"):
+                st.warning(f"Skipped {review['unreadable_figure_count']} figure(s) that could not be read.")
+            st.subheader("Peer Review Feedback")
+
+            for heading, feedback in review["sections"]:
+                if pipeline["layout"] == "expanders":
+                    with st.expander(heading, expanded=True):
+                        st.write(feedback)
+                else:
+                    st.markdown(heading)
+                    st.write(feedback)
+            st.caption(f"Rubric version {rubric_version}")
+            if condensed_prior is not None:
+                saved = condensed_prior["original_tokens"] - condensed_prior["condensed_tokens"]
+                st.caption(
+                    f"Prior submission condensed from {condensed_prior['original_tokens']:,} to "
+                    f"{condensed_prior['condensed_tokens']:,} tokens ({saved:,} saved per request)."
+                )
+            if review["local_citation_count"]:
+                mode = ("instead of a web search" if review["local_citation_count"] >= CITATION_SKIP_MIN
+                        else "alongside a narrowed web search")
+                st.caption(
+                    f"Used {review['local_citation_count']} verified source(s) from the course citation library {mode}."
+                )
 
     else:
         st.info("Please upload your document(s) above to receive feedback.")
@@ -809,6 +2025,7 @@ def main_app():
 # ─────────────────────────────────────────────
 
 def main():
+    get_rubric_registry()  # load and validate all prompts on the first run
     params = st.query_params
     if params.get("admin") == "true":
         admin_panel()
@@ -0,0 +1,89 @@
+"""Regression checks for figure captions in Word documents (extract_docx_content in app.py).
+
+Each case builds a small .docx with python-docx and checks the caption paired
+with each figure. Needs the app's requirements installed, since it imports app.py.
+
+Usage: python check_docx_captions.py
+"""
+import io
+import struct
+import sys
+import zlib
+
+from docx import Document
+
+from app import extract_docx_content
+
+
+def tiny_png():
+    """A valid 1x1 grey PNG, so the check needs no image library."""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(b"\x00\x80")) + chunk(b"IEND", b""))
+
+
+def build(blocks):
+    """Build a document from ("text", str), ("caption", str) and ("image", None) blocks."""
+    doc = Document()
+    for kind, text in blocks:
+        if kind == "image":
+            doc.add_picture(io.BytesIO(tiny_png()))
+        elif kind == "caption":
+            doc.add_paragraph(text, style="Caption")
+        else:
+            doc.add_paragraph(text)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    buffer.seek(0)
+    return Document(buffer)
+
+
+CASES = [
+    (
+        "caption below wins over a results sentence above",
+        [
+            ("text", "Figure 1 shows that heart rate increased with exercise intensity (p < 0.01)."),
+            ("image", None),
+            ("caption", "Figure 1. Mean heart rate at rest and during exercise."),
+        ],
+        ["Figure 1. Mean heart rate at rest and during exercise."],
+    ),
+    (
+        "caption above is used when none follows",
+        [
+            ("text", "Figure 2: Blood lactate by condition"),
+            ("image", None),
+            ("text", "Lactate rose in every participant."),
+        ],
+        ["Figure 2: Blood lactate by condition"],
+    ),
+    (
+        "a results sentence is never a caption",
+        [
+            ("text", "Figure 3 shows no difference between groups (p = 0.41)."),
+            ("image", None),
+            ("text", "Core temperature was similar across sessions."),
+        ],
+        [None],
+    ),
+]
+
+
+def main():
+    failures = []
+    for name, blocks, expected in CASES:
+        _, figures = extract_docx_content(build(blocks), analyze_figures=True)
+        captions = [figure.caption for figure in figures]
+        if captions != expected:
+            failures.append(f"{name}: got {captions!r}, expected {expected!r}")
+    if failures:
+        print("FAILED:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+    print(f"OK: {len(CASES)} caption case(s)")
+
+
+if __name__ == "__main__":
+    main()
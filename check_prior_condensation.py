@@ -0,0 +1,66 @@
+"""Regression checks for prior-module condensation (condense_prior_text in app.py).
+
+Each case condenses a small prior document for a module and checks which
+lines survive. Needs the app's requirements installed, since it imports app.py.
+
+Usage: python check_prior_condensation.py
+"""
+import sys
+
+from app import condense_prior_text
+
+FILLER = " ".join(["Participants completed every session as scheduled."] * 12)
+# Long enough that the condensed text is used rather than the MIN_CONDENSED_WORDS fallback;
+# the core temperature line matches no Module 6 sentence pattern, so only its section keeps it
+RESULT_DETAIL = "in both the trained and untrained groups across all three sessions"
+
+CASES = [
+    (
+        "figure inside a kept Results section",
+        "6 - Discussion Section",
+        "\n".join([
+            "Introduction",
+            FILLER,
+            "Results",
+            "Heart rate increased significantly during exercise (p < 0.001).",
+            "[Figure 1]",
+            "Figure 1. Heart rate across conditions",
+            f"Recovery heart rate was lower after training {RESULT_DETAIL} (p = 0.02).",
+            f"Core temperature rose steadily over the final ten minutes {RESULT_DETAIL}.",
+            f"Mean lactate was elevated in the hot condition {RESULT_DETAIL} (p = 0.01).",
+            "References",
+            "Smith J. (2020). A study. Journal.",
+        ]),
+        [
+            "Heart rate increased significantly during exercise (p < 0.001).",
+            "[Figure 1]",
+            "Figure 1. Heart rate across conditions",
+            f"Recovery heart rate was lower after training {RESULT_DETAIL} (p = 0.02).",
+            f"Core temperature rose steadily over the final ten minutes {RESULT_DETAIL}.",
+            f"Mean lactate was elevated in the hot condition {RESULT_DETAIL} (p = 0.01).",
+        ],
+        [FILLER, "Smith J. (2020). A study. Journal."],
+    ),
+]
+
+
+def main():
+    failures = []
+    for name, module, prior_text, expected, unexpected in CASES:
+        kept = condense_prior_text(prior_text, module)["text"].splitlines()
+        for line in expected:
+            if line not in kept:
+                failures.append(f"{name}: dropped {line!r}")
+        for line in unexpected:
+            if line in kept:
+                failures.append(f"{name}: kept {line!r}")
+    if failures:
+        print("FAILED:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+    print(f"OK: {len(CASES)} condensation case(s)")
+
+
+if __name__ == "__main__":
+    main()
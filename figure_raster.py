@@ -0,0 +1,168 @@
+"""Detect vector-drawn figures in PDF pages and rasterize them in a process pool.
+
+Charts exported from Excel, Prism or R usually land in a PDF as drawing
+commands rather than embedded images, so `page.get_images` never sees them.
+This module clusters a page's drawing paths into figure regions and renders
+only those regions, at a bounded DPI and under a total pixel budget.
+
+It is kept separate from app.py so the rasterizer can be pickled into
+worker processes.
+"""
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+
+# Rendering limits (overridable from .env)
+VECTOR_FIGURE_MAX_DPI = int(os.getenv("VECTOR_FIGURE_MAX_DPI", "150"))
+MAX_FIGURE_PIXELS = int(os.getenv("MAX_FIGURE_PIXELS", "4000000"))
+MAX_TOTAL_FIGURE_PIXELS = int(os.getenv("MAX_TOTAL_FIGURE_PIXELS", "24000000"))
+RASTER_WORKERS = int(os.getenv("RASTER_WORKERS", "2"))
+
+# Region detection tuning, in PDF points (1/72 inch)
+CLUSTER_GAP = 12          # paths closer than this belong to the same figure
+LABEL_MARGIN = 14         # padding added around a cluster to catch axis labels
+MIN_FIGURE_SIZE = 72      # ignore clusters smaller than 1 inch in either direction
+MIN_CHART_PATHS = 3       # filled shapes, curves or diagonal lines needed to count as a chart
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_raster_pool():
+    """Return the shared rasterizer pool, starting it on first use.
+
+    Workers are spawned rather than forked because the Streamlit server is
+    multithreaded.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=RASTER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def _is_rule(drawing):
+    """True for table borders and underlines: unfilled, axis-aligned straight strokes."""
+    if drawing.get("fill") is not None:
+        rect = drawing["rect"]
+        return rect.width < 2 or rect.height < 2
+    for item in drawing["items"]:
+        if item[0] == "l":
+            p1, p2 = item[1], item[2]
+            if abs(p1.x - p2.x) > 0.5 and abs(p1.y - p2.y) > 0.5:
+                return False
+        elif item[0] == "re":
+            if item[1].width >= 2 and item[1].height >= 2:
+                return False
+        else:  # curves and quads
+            return False
+    return True
+
+
+def _padded(rect, pad):
+    return fitz.Rect(rect.x0 - pad, rect.y0 - pad, rect.x1 + pad, rect.y1 + pad)
+
+
+def _table_rects(page):
+    """Bounding boxes of the tables PyMuPDF finds on `page` (none if detection fails)."""
+    try:
+        return [fitz.Rect(table.bbox) for table in page.find_tables().tables]
+    except Exception:
+        return []
+
+
+def find_vector_figure_regions(page, exclude_rects=()):
+    """Return rects on `page` that look like vector-drawn charts.
+
+    Drawing paths are greedily merged while they lie within CLUSTER_GAP of
+    each other. Clusters made only of rules (e.g. table grids), clusters
+    smaller than MIN_FIGURE_SIZE and clusters mostly covered by an
+    `exclude_rects` entry (already-extracted raster images) or by a detected
+    table (whose shaded cells would otherwise count as chart paths) are
+    dropped.
+    """
+    page_rect = page.rect
+    clusters = []  # [rect, chart_path_count]
+    for drawing in page.get_drawings():
+        rect = fitz.Rect(drawing["rect"])
+        if rect.is_empty:
+            # Horizontal and vertical lines (e.g. chart axes) have zero-area rects,
+            # which rect unions ignore; give them a hairline thickness
+            rect = _padded(rect, 0.5)
+        if rect.width > page_rect.width * 0.9 and rect.height > page_rect.height * 0.9:
+            continue  # page background or border
+        count = 0 if _is_rule(drawing) else 1
+        padded = _padded(rect, CLUSTER_GAP)
+        merged = [rect, count]
+        remaining = []
+        for cluster in clusters:
+            if _padded(cluster[0], CLUSTER_GAP).intersects(padded):
+                merged[0] = merged[0] | cluster[0]
+                merged[1] += cluster[1]
+            else:
+                remaining.append(cluster)
+        clusters = remaining + [merged]
+
+    # A merge can make a cluster reach one it skipped earlier
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(clusters)):
+            for j in range(i + 1, len(clusters)):
+                if _padded(clusters[i][0], CLUSTER_GAP).intersects(_padded(clusters[j][0], CLUSTER_GAP)):
+                    clusters[i] = [clusters[i][0] | clusters[j][0], clusters[i][1] + clusters[j][1]]
+                    del clusters[j]
+                    changed = True
+                    break
+            if changed:
+                break
+
+    exclude_rects = list(exclude_rects)
+    if clusters:
+        exclude_rects += _table_rects(page)
+    regions = []
+    for rect, count in clusters:
+        if count < MIN_CHART_PATHS:
+            continue
+        if rect.width < MIN_FIGURE_SIZE or rect.height < MIN_FIGURE_SIZE:
+            continue
+        if any(abs(rect & other) > 0.5 * abs(rect) for other in exclude_rects):
+            continue
+        regions.append(_padded(rect, LABEL_MARGIN) & page_rect)
+    return sorted(regions, key=lambda r: (r.y0, r.x0))
+
+
+def plan_dpi(rect, pixels_left):
+    """Pick a DPI for `rect` within the per-figure and remaining total pixel budgets.
+
+    Returns (dpi, pixels), or (None, 0) if the budget cannot fit a legible render.
+    """
+    area_in = (rect.width / 72) * (rect.height / 72)
+    if area_in <= 0:
+        return None, 0
+    budget = min(MAX_FIGURE_PIXELS, pixels_left)
+    dpi = min(VECTOR_FIGURE_MAX_DPI, int(math.sqrt(budget / area_in)))
+    if dpi < 72:
+        return None, 0
+    return dpi, int(area_in * dpi * dpi)
+
+
+def rasterize_region(source, page_number, clip, dpi):
+    """Render one region of a PDF page to PNG (runs in a worker process).
+
+    `source` is a file path or the PDF bytes. Returns (png_bytes, width, height).
+    """
+    if isinstance(source, str):
+        doc = fitz.open(source, filetype="pdf")
+    else:
+        doc = fitz.open(stream=source, filetype="pdf")
+    with doc:
+        pix = doc[page_number].get_pixmap(clip=fitz.Rect(clip), dpi=dpi)
+        return pix.tobytes("png"), pix.width, pix.height
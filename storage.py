@@ -0,0 +1,504 @@
+"""Shared state for the peer reviewer: the submission log, its hourly rollups,
+finished review results, per-group usage and quotas, and the citation store.
+
+app.py talks to a SubmissionStore opened from a URL (STORAGE_URL), so
+replicas can share one backend. `sqlite:///path.db` is safe for any number
+of processes on one host; a network store can be added later by
+implementing the same methods and registering its URL scheme in
+STORE_BACKENDS.
+
+Kept separate from app.py so it can be used outside Streamlit (e.g. by
+stress_test_storage.py).
+"""
+import abc
+import csv
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+SUBMISSION_FIELDS = ["timestamp", "module", "groupnumber", "included_figures", "rubric_version"]
+ROLLUP_FIELDS = ["hour", "module", "groupnumber", "count"]
+QUOTA_FIELDS = ["reviews_per_hour", "tokens_per_day", "cooldown_seconds"]
+HOUR_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2})[ T](\d{2})')
+
+
+def submission_hour(timestamp_str):
+    """Truncate an ISO timestamp to its hour bucket ('YYYY-MM-DD HH:00'), or None."""
+    match = HOUR_PATTERN.match(timestamp_str or "")
+    if match is None:
+        return None
+    return f"{match.group(1)} {match.group(2)}:00"
+
+
+class SubmissionStore(abc.ABC):
+    """Interface every storage backend implements.
+
+    Submissions are dicts with the SUBMISSION_FIELDS plus a caller-chosen
+    unique `submission_id`, which makes appends idempotent when retried.
+    Stored submissions also carry a backend-assigned `id` used for removal.
+    A backend that misses a method fails when it is constructed.
+    """
+
+    @abc.abstractmethod
+    def append_submission(self, submission):
+        """Store a submission; returns False if its submission_id was already stored."""
+
+    @abc.abstractmethod
+    def list_submissions(self):
+        ...
+
+    @abc.abstractmethod
+    def iter_submissions(self, start_date=None, end_date=None, modules=None):
+        """Yield submissions (SUBMISSION_FIELDS only) dated within [start_date, end_date] in `modules`."""
+
+    @abc.abstractmethod
+    def remove_submission(self, submission_id):
+        """Remove one submission by its `id`; returns whether it existed."""
+
+    @abc.abstractmethod
+    def remove_group_submissions(self, group_number, module=None):
+        """Remove a group's submissions (for one module, or all); returns how many."""
+
+    @abc.abstractmethod
+    def reset_all(self):
+        """Remove every submission; returns how many."""
+
+    @abc.abstractmethod
+    def rollups(self):
+        """Return {(hour, module, groupnumber): count}, kept current by every write."""
+
+    @abc.abstractmethod
+    def save_review(self, review_key, review):
+        ...
+
+    @abc.abstractmethod
+    def get_review(self, review_key):
+        """Return a saved review dict, or None."""
+
+    # Per-group usage and quotas
+
+    @abc.abstractmethod
+    def get_group_quota(self, group_number):
+        """Return the group's quota overrides ({field: value} for QUOTA_FIELDS that are set)."""
+
+    @abc.abstractmethod
+    def set_group_quota(self, group_number, quota):
+        """Override a group's limits; a value of None uses the default."""
+
+    @abc.abstractmethod
+    def clear_group_quota(self, group_number):
+        ...
+
+    @abc.abstractmethod
+    def start_usage(self, group_number, module, admit):
+        """Atomically check a group's usage and record the start of a review.
+
+        `admit(quota_overrides, stats, now)` returns None to allow the review
+        or a refusal message. `stats` holds last_review (ts or None),
+        module_reviews_hour, first_module_review_hour, tokens_day, tokens_hour
+        and active_groups_hour (a set of group numbers); reviews marked
+        failed are not counted as reviews, but their tokens are. Returns
+        (usage_id, None), or (None, message) when refused.
+        """
+
+    @abc.abstractmethod
+    def finish_usage(self, usage_id, api_requests, tokens, failed=False):
+        ...
+
+    @abc.abstractmethod
+    def usage_summary(self, since):
+        """Return per (group, module) totals of reviews, failed reviews, API requests and tokens since `since`."""
+
+    @abc.abstractmethod
+    def reset_group_usage(self, group_number):
+        ...
+
+    # Citation store
+
+    @abc.abstractmethod
+    def touch_citation(self, doi, module, topic, seen_at):
+        """Note another citation of a stored DOI (its harvested_at is kept); returns False if not stored."""
+
+    @abc.abstractmethod
+    def add_citation(self, citation):
+        """Store a verified citation: doi, title, abstract, journal, year, reference, topic, modules, harvested_at."""
+
+    @abc.abstractmethod
+    def list_citations(self, since):
+        """Return the citations first harvested at or after the ISO timestamp `since`."""
+
+
+class SQLiteStore(SubmissionStore):
+    """SubmissionStore in one SQLite database in WAL mode.
+
+    Every write runs in a BEGIN IMMEDIATE transaction, so concurrent writers
+    from any number of processes queue on the database lock (up to
+    `timeout` seconds) instead of failing or losing updates. Rollups are
+    updated in the same transaction as the rows they count.
+    """
+
+    def __init__(self, path, timeout=30, review_retention_days=14):
+        self.path = path
+        self.timeout = timeout
+        self.review_retention_seconds = review_retention_days * 86400
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS submissions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    submission_id TEXT NOT NULL UNIQUE,
+                    timestamp TEXT NOT NULL,
+                    module TEXT NOT NULL,
+                    groupnumber TEXT NOT NULL,
+                    included_figures TEXT,
+                    rubric_version TEXT
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS rollups (
+                    hour TEXT NOT NULL,
+                    module TEXT NOT NULL,
+                    groupnumber TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (hour, module, groupnumber)
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS reviews (
+                    review_key TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL,
+                    payload TEXT NOT NULL
+                )"""
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts REAL NOT NULL,
+                    groupnumber TEXT NOT NULL,
+                    module TEXT NOT NULL,
+                    api_requests INTEGER NOT NULL DEFAULT 0,
+                    tokens INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS usage_group_ts ON usage (groupnumber, ts)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS quotas (
+                    groupnumber TEXT PRIMARY KEY,
+                    reviews_per_hour INTEGER,
+                    tokens_per_day INTEGER,
+                    cooldown_seconds INTEGER
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS citations (
+                    doi TEXT PRIMARY KEY,
+                    title TEXT,
+                    abstract TEXT,
+                    journal TEXT,
+                    year INTEGER,
+                    reference TEXT,
+                    topic TEXT,
+                    modules TEXT,
+                    times_seen INTEGER NOT NULL DEFAULT 1,
+                    harvested_at TEXT NOT NULL,
+                    last_seen TEXT
+                )"""
+            )
+
+    @classmethod
+    def from_url(cls, location):
+        # sqlite:///relative.db or sqlite:////absolute/path.db
+        return cls(location[1:] if location.startswith("/") else location)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    class _Transaction:
+        def __init__(self, conn):
+            self.conn = conn
+
+        def __enter__(self):
+            self.conn.execute("BEGIN IMMEDIATE")
+            return self.conn
+
+        def __exit__(self, exc_type, exc, tb):
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+            return False
+
+    def _transaction(self):
+        return self._Transaction(self._connection())
+
+    def _bump_rollup(self, conn, submission, delta):
+        hour = submission_hour(submission["timestamp"])
+        if hour is None:
+            return
+        key = (hour, submission["module"], submission["groupnumber"])
+        conn.execute(
+            "INSERT INTO rollups (hour, module, groupnumber, count) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (hour, module, groupnumber) DO UPDATE SET count = count + excluded.count",
+            key + (delta,)
+        )
+        if delta < 0:
+            conn.execute(
+                "DELETE FROM rollups WHERE hour = ? AND module = ? AND groupnumber = ? AND count <= 0", key
+            )
+
+    def _rebuild_rollups(self, conn):
+        conn.execute("DELETE FROM rollups")
+        rollups = {}
+        for row in conn.execute("SELECT timestamp, module, groupnumber FROM submissions"):
+            hour = submission_hour(row["timestamp"])
+            if hour is not None:
+                key = (hour, row["module"], row["groupnumber"])
+                rollups[key] = rollups.get(key, 0) + 1
+        conn.executemany(
+            "INSERT INTO rollups (hour, module, groupnumber, count) VALUES (?, ?, ?, ?)",
+            [(hour, module, group, count) for (hour, module, group), count in rollups.items()]
+        )
+
+    def append_submission(self, submission):
+        with self._transaction() as conn:
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO submissions "
+                "(submission_id, timestamp, module, groupnumber, included_figures, rubric_version) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (submission["submission_id"], submission["timestamp"], submission["module"],
+                 submission["groupnumber"], submission.get("included_figures", ""),
+                 submission.get("rubric_version", ""))
+            ).rowcount == 1
+            if inserted:
+                self._bump_rollup(conn, submission, 1)
+        return inserted
+
+    def import_csv_once(self, csv_path):
+        """Copy a legacy submission_log.csv into the store the first time it is opened."""
+        if not os.path.exists(csv_path):
+            return 0
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'csv_imported'").fetchone():
+                return 0
+            imported = 0
+            with open(csv_path, mode='r', newline='', encoding='utf-8') as file:
+                for i, row in enumerate(csv.DictReader(file)):
+                    fingerprint = hashlib.sha256(f"{i}\0{sorted(row.items())}".encode('utf-8')).hexdigest()[:20]
+                    imported += conn.execute(
+                        "INSERT OR IGNORE INTO submissions "
+                        "(submission_id, timestamp, module, groupnumber, included_figures, rubric_version) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (f"legacy-{fingerprint}", row.get("timestamp") or "", row.get("module") or "",
+                         row.get("groupnumber") or "", row.get("included_figures") or "",
+                         row.get("rubric_version") or "")
+                    ).rowcount
+            self._rebuild_rollups(conn)
+            conn.execute("INSERT INTO meta (key, value) VALUES ('csv_imported', ?)", (csv_path,))
+        return imported
+
+    def list_submissions(self):
+        return [dict(row) for row in self._connection().execute("SELECT * FROM submissions ORDER BY id")]
+
+    def iter_submissions(self, start_date=None, end_date=None, modules=None):
+        query = "SELECT timestamp, module, groupnumber, included_figures, rubric_version FROM submissions WHERE 1 = 1"
+        params = []
+        if start_date:
+            query += " AND substr(timestamp, 1, 10) >= ?"
+            params.append(start_date.isoformat())
+        if end_date:
+            query += " AND substr(timestamp, 1, 10) <= ?"
+            params.append(end_date.isoformat())
+        if modules:
+            query += f" AND module IN ({', '.join('?' * len(modules))})"
+            params.extend(modules)
+        # A separate connection so a long export never holds this thread's connection
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        conn.row_factory = sqlite3.Row
+        try:
+            for row in conn.execute(query + " ORDER BY id", params):
+                yield {field: row[field] or "" for field in SUBMISSION_FIELDS}
+        finally:
+            conn.close()
+
+    def remove_submission(self, submission_id):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT * FROM submissions WHERE id = ?", (submission_id,)).fetchone()
+            if row is None:
+                return False
+            conn.execute("DELETE FROM submissions WHERE id = ?", (submission_id,))
+            self._bump_rollup(conn, row, -1)
+        return True
+
+    def remove_group_submissions(self, group_number, module=None):
+        with self._transaction() as conn:
+            if module is None:
+                removed = conn.execute(
+                    "DELETE FROM submissions WHERE groupnumber = ?", (group_number,)
+                ).rowcount
+            else:
+                removed = conn.execute(
+                    "DELETE FROM submissions WHERE groupnumber = ? AND module = ?", (group_number, module)
+                ).rowcount
+            self._rebuild_rollups(conn)
+        return removed
+
+    def reset_all(self):
+        with self._transaction() as conn:
+            removed = conn.execute("DELETE FROM submissions").rowcount
+            conn.execute("DELETE FROM rollups")
+        return removed
+
+    def rollups(self):
+        return {
+            (row["hour"], row["module"], row["groupnumber"]): row["count"]
+            for row in self._connection().execute("SELECT * FROM rollups")
+        }
+
+    def save_review(self, review_key, review):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO reviews (review_key, created_at, payload) VALUES (?, ?, ?)",
+                (review_key, now, json.dumps(review))
+            )
+            conn.execute("DELETE FROM reviews WHERE created_at < ?", (now - self.review_retention_seconds,))
+
+    def get_review(self, review_key):
+        row = self._connection().execute(
+            "SELECT payload FROM reviews WHERE review_key = ?", (review_key,)
+        ).fetchone()
+        return json.loads(row["payload"]) if row else None
+
+    def get_group_quota(self, group_number):
+        row = self._connection().execute(
+            "SELECT * FROM quotas WHERE groupnumber = ?", (group_number,)
+        ).fetchone()
+        if row is None:
+            return {}
+        return {field: row[field] for field in QUOTA_FIELDS if row[field] is not None}
+
+    def set_group_quota(self, group_number, quota):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO quotas (groupnumber, reviews_per_hour, tokens_per_day, cooldown_seconds) "
+                "VALUES (?, ?, ?, ?)",
+                (group_number, quota["reviews_per_hour"], quota["tokens_per_day"], quota["cooldown_seconds"])
+            )
+
+    def clear_group_quota(self, group_number):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM quotas WHERE groupnumber = ?", (group_number,))
+
+    def _usage_stats(self, conn, group_number, module, now):
+        hour_start = now - 3600
+        module_hour = conn.execute(
+            "SELECT COUNT(*), MIN(ts) FROM usage WHERE groupnumber = ? AND module = ? AND ts >= ? AND NOT failed",
+            (group_number, module, hour_start)
+        ).fetchone()
+        return {
+            "last_review": conn.execute(
+                "SELECT MAX(ts) FROM usage WHERE groupnumber = ? AND NOT failed", (group_number,)
+            ).fetchone()[0],
+            "module_reviews_hour": module_hour[0],
+            "first_module_review_hour": module_hour[1],
+            "tokens_day": conn.execute(
+                "SELECT COALESCE(SUM(tokens), 0) FROM usage WHERE groupnumber = ? AND ts >= ?",
+                (group_number, now - 86400)
+            ).fetchone()[0],
+            "tokens_hour": conn.execute(
+                "SELECT COALESCE(SUM(tokens), 0) FROM usage WHERE groupnumber = ? AND ts >= ?",
+                (group_number, hour_start)
+            ).fetchone()[0],
+            "active_groups_hour": {row[0] for row in conn.execute(
+                "SELECT DISTINCT groupnumber FROM usage WHERE ts >= ?", (hour_start,)
+            )},
+        }
+
+    def start_usage(self, group_number, module, admit):
+        # The write lock is held from the check to the insert, so two sessions
+        # of one group cannot both pass the check
+        with self._transaction() as conn:
+            now = time.time()
+            quota_row = conn.execute("SELECT * FROM quotas WHERE groupnumber = ?", (group_number,)).fetchone()
+            overrides = {field: quota_row[field] for field in QUOTA_FIELDS
+                         if quota_row is not None and quota_row[field] is not None}
+            message = admit(overrides, self._usage_stats(conn, group_number, module, now), now)
+            if message:
+                return None, message
+            return conn.execute(
+                "INSERT INTO usage (ts, groupnumber, module) VALUES (?, ?, ?)",
+                (now, group_number, module)
+            ).lastrowid, None
+
+    def finish_usage(self, usage_id, api_requests, tokens, failed=False):
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE usage SET api_requests = ?, tokens = ?, failed = ? WHERE id = ?",
+                (api_requests, tokens, int(failed), usage_id)
+            )
+
+    def usage_summary(self, since):
+        return [dict(row) for row in self._connection().execute(
+            "SELECT groupnumber, module, SUM(NOT failed) AS reviews, SUM(failed) AS failed_reviews, "
+            "SUM(api_requests) AS api_requests, "
+            "SUM(tokens) AS tokens, MAX(ts) AS last_review FROM usage WHERE ts >= ? "
+            "GROUP BY groupnumber, module ORDER BY tokens DESC",
+            (since,)
+        )]
+
+    def reset_group_usage(self, group_number):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM usage WHERE groupnumber = ?", (group_number,))
+
+    def touch_citation(self, doi, module, topic, seen_at):
+        with self._transaction() as conn:
+            known = conn.execute("SELECT modules FROM citations WHERE doi = ?", (doi,)).fetchone()
+            if known is None:
+                return False
+            modules = set(known["modules"].split(",")) | {module}
+            conn.execute(
+                "UPDATE citations SET times_seen = times_seen + 1, last_seen = ?, modules = ?, "
+                "topic = substr(topic || ' ' || ?, 1, 4000) WHERE doi = ?",
+                (seen_at, ",".join(sorted(modules)), topic, doi)
+            )
+        return True
+
+    def add_citation(self, citation):
+        # Another replica may have stored the DOI while Crossref was being asked
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO citations (doi, title, abstract, journal, year, reference, topic, modules, harvested_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (doi) DO UPDATE SET times_seen = times_seen + 1, last_seen = excluded.harvested_at",
+                (citation["doi"], citation["title"], citation["abstract"], citation["journal"], citation["year"],
+                 citation["reference"], citation["topic"], citation["modules"], citation["harvested_at"])
+            )
+
+    def list_citations(self, since):
+        return [dict(row) for row in self._connection().execute(
+            "SELECT * FROM citations WHERE harvested_at >= ?", (since,)
+        )]
+
+
+STORE_BACKENDS = {
+    "sqlite": SQLiteStore,
+}
+
+
+def open_store(url):
+    """Open the store for a URL such as "sqlite:///shared_state.db"."""
+    scheme, separator, location = url.partition("://")
+    if not separator or scheme not in STORE_BACKENDS:
+        raise ValueError(f"Unsupported STORAGE_URL {url!r}; expected one of: "
+                         + ", ".join(f"{name}://..." for name in STORE_BACKENDS))
+    return STORE_BACKENDS[scheme].from_url(location)
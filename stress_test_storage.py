@@ -0,0 +1,127 @@
+"""Multi-process stress test for the shared-state store (storage.py).
+
+Several writer processes append submissions at the same time, each retrying
+every tenth write to simulate a client retry, while a janitor process keeps
+deleting one group's submissions. Afterwards the store must hold exactly one
+row per unique write, reject every retry, and have rollups that match the
+rows.
+
+Usage: python stress_test_storage.py [--processes 8] [--writes 200] [--url sqlite:///path.db]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from storage import open_store, submission_hour
+
+MODULES = ["2 - Research Questions", "3 - Study Design", "5 - Presenting Results"]
+JANITOR_GROUP = "999"
+
+
+def writer(url, worker, writes, results):
+    store = open_store(url)
+    inserted = duplicates = 0
+    start = datetime(2026, 1, 1)
+    for i in range(writes):
+        group = JANITOR_GROUP if worker == 0 else str(worker)
+        submission = {
+            "submission_id": f"w{worker}-{i}",
+            # Spread writes over a few hours so several rollup buckets are contended
+            "timestamp": (start + timedelta(minutes=7 * i)).isoformat(),
+            "module": MODULES[i % len(MODULES)],
+            "groupnumber": group,
+            "included_figures": "False",
+        }
+        inserted += store.append_submission(submission)
+        if i % 10 == 0:
+            duplicates += not store.append_submission(submission)
+    results.put((worker, inserted, duplicates))
+
+
+def janitor(url, stop):
+    store = open_store(url)
+    while not stop.is_set():
+        store.remove_group_submissions(JANITOR_GROUP)
+        time.sleep(0.01)
+    store.remove_group_submissions(JANITOR_GROUP)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--writes", type=int, default=200)
+    parser.add_argument("--url", default=None)
+    args = parser.parse_args()
+
+    tmp_dir = None
+    url = args.url
+    if url is None:
+        tmp_dir = tempfile.mkdtemp(prefix="bioc32_stress_")
+        url = f"sqlite:///{os.path.join(tmp_dir, 'stress.db')}"
+    open_store(url).reset_all()
+
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    stop = ctx.Event()
+    janitor_process = ctx.Process(target=janitor, args=(url, stop))
+    janitor_process.start()
+    writers = [ctx.Process(target=writer, args=(url, worker, args.writes, results))
+               for worker in range(args.processes)]
+    started = time.time()
+    for process in writers:
+        process.start()
+    reports = [results.get(timeout=600) for _ in writers]
+    for process in writers:
+        process.join()
+    stop.set()
+    janitor_process.join()
+    elapsed = time.time() - started
+
+    store = open_store(url)
+    rows = store.list_submissions()
+    failures = []
+
+    retries = (args.writes + 9) // 10
+    for worker, inserted, duplicates in sorted(reports):
+        if inserted != args.writes:
+            failures.append(f"writer {worker}: {inserted} of {args.writes} writes inserted")
+        # The janitor may delete a group 999 row before its retry, so only check the other writers
+        if worker != 0 and duplicates != retries:
+            failures.append(f"writer {worker}: {duplicates} of {retries} retries rejected")
+
+    expected_ids = {f"w{worker}-{i}" for worker in range(1, args.processes) for i in range(args.writes)}
+    stored_ids = [row["submission_id"] for row in rows]
+    if len(stored_ids) != len(set(stored_ids)):
+        failures.append(f"{len(stored_ids) - len(set(stored_ids))} duplicated rows")
+    if set(stored_ids) != expected_ids:
+        failures.append(f"{len(expected_ids - set(stored_ids))} lost rows, "
+                        f"{len(set(stored_ids) - expected_ids)} unexpected rows")
+
+    expected_rollups = {}
+    for row in rows:
+        key = (submission_hour(row["timestamp"]), row["module"], row["groupnumber"])
+        expected_rollups[key] = expected_rollups.get(key, 0) + 1
+    if store.rollups() != expected_rollups:
+        failures.append("rollups do not match the stored rows")
+
+    total_writes = args.processes * (args.writes + retries)
+    print(f"{args.processes} processes, {total_writes} writes and a concurrent janitor in {elapsed:.1f}s")
+    print(f"{len(rows)} rows stored, {len(expected_rollups)} rollup buckets")
+    if tmp_dir is not None:
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+    if failures:
+        print("FAILED:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+    print("OK: no lost or duplicated writes")
+
+
+if __name__ == "__main__":
+    main()